@@ -1,11 +1,19 @@
+import base64
+import hashlib
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_daq as daq
+import numpy as np
 import plotly.graph_objs as go
-from dash.dependencies import Input, Output
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 from datetime import datetime
-from model import run_SEIR
+import observed
+import shared
+from jobs import JobQueue
+from model import run_epidemic, run_SEIR_wide
+from supply import SupplySchedule
 
 # Step 1. Launch the application
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -19,6 +27,10 @@ app = dash.Dash(
 
 server = app.server
 
+# model runs go to a process pool, the callbacks only submit and poll; serve with one gunicorn worker
+# process and several threads (Procfile) so every poll reaches the process that holds the jobs
+jobs = JobQueue(workers=shared.JOB_WORKERS, ttl=shared.JOB_RESULT_TTL)
+
 # Step 2. Create a Dash layout
 layout = dict(
     autosize=True,
@@ -89,11 +101,11 @@ app.layout = html.Div(
                 html.Div(  # left col
                     [
                         html.Label('Population'),
-                        dcc.Input(id='population', value='10000000', type='number'),
+                        dcc.Input(id='population', value='10000000', type='number', debounce=True),
                         html.Label('Date of first infection'),
-                        dcc.Input(id='date-of-first-infection', value='01-15-2020', type='text'),
+                        dcc.Input(id='date-of-first-infection', value='01-15-2020', type='text', debounce=True),
                         html.Label('Date when social distancing begins'),
-                        dcc.Input(id='date-of-lockdown', value='03-15-2020', type='text'),
+                        dcc.Input(id='date-of-lockdown', value='03-15-2020', type='text', debounce=True),
                     ],
                     className="pretty_container four columns",
                     id="demographic-options",
@@ -101,16 +113,21 @@ app.layout = html.Div(
                 html.Div(  # middle col
                     [
                         html.Label('Number of intensive units available'),
-                        dcc.Input(id='intensive-units', value='5000', type='number'),
+                        dcc.Input(id='intensive-units', value='5000', type='number', debounce=True),
                         html.Label('Mean number of days person stays in ICU'),
-                        dcc.Input(id='mean_days_icu', value='5', type='number'),
+                        dcc.Input(id='mean_days_icu', value='5', type='number', debounce=True),
                         # ventilators
                         html.Label('Number of ventilators available to start.'),
-                        dcc.Input(id='vents-units-start', value='5000', type='number'),
+                        dcc.Input(id='vents-units-start', value='5000', type='number', debounce=True),
                         html.Label('Number of ventilators in first shipment.'),
-                        dcc.Input(id='vents-units-shipment-1', value='200', type='number'),
+                        dcc.Input(id='vents-units-shipment-1', value='200', type='number', debounce=True),
                         html.Label('Date of first shipment.'),
-                        dcc.Input(id='vents-date-shipment-1', value='03-20-2020', type='text'),
+                        dcc.Input(id='vents-date-shipment-1', value='03-20-2020', type='text', debounce=True),
+                        html.Label('Or a shipment schedule replacing the first shipment, one "date, units" per line '
+                                   '(negative units for losses and transfers).'),
+                        dcc.Textarea(id='vents-schedule', value='', placeholder='03-20-2020, 200\n04-01-2020, -50'),
+                        html.Button('Apply schedule', id='vents-schedule-apply'),
+                        dcc.Upload(id='vents-schedule-upload', children=html.Button('Upload schedule (csv)')),
                     ],
                     className="pretty_container four columns",
                     id="medical-options",
@@ -122,6 +139,8 @@ app.layout = html.Div(
                             id='y-axis-toggle',
                             value=False
                         ),
+                        html.Label('Overlay observed cases and deaths, aligned to the model by deaths.'),
+                        dcc.Dropdown(id='observed-region', placeholder='Country or province'),
                     ],
                     className="pretty_container four columns",
                     id="visual-options",
@@ -129,7 +148,21 @@ app.layout = html.Div(
             ],
             className="row flex-display",
         ),
-        dcc.Graph(id='line-plot'),
+        dcc.Store(id='job'),
+        dcc.Interval(id='job-poll', interval=250, disabled=True),
+        # traces that changed since the last run, content hashes of the traces the browser has
+        dcc.Store(id='trace-updates'),
+        dcc.Store(id='trace-hashes'),
+        # observed traces of the selected region, replaced as a whole
+        dcc.Store(id='observed-traces'),
+        html.Div(id='job-status'),
+        dcc.Graph(id='line-plot', figure=go.Figure(
+            layout=go.Layout(xaxis={'title': 'Time'},
+                             yaxis={'title': 'count', 'type': 'log'},
+                             margin={'l': 40, 'b': 40, 't': 50, 'r': 50},
+                             hovermode='closest',
+                             width=1200,
+                             height=800))),
         html.Div(id='my-div'),
     ])
 
@@ -143,7 +176,22 @@ def update_output_div(input_value):
 
 
 @app.callback(
-    Output(component_id='line-plot', component_property='figure'),
+    Output(component_id='vents-schedule', component_property='value'),
+    [Input(component_id='vents-schedule-upload', component_property='contents')],
+)
+def load_vents_schedule(contents):
+    if contents is None:
+        raise PreventUpdate
+    return decode_upload(contents)
+
+
+def decode_upload(contents):
+    # uploads arrive as 'data:<mime type>;base64,<data>'
+    return base64.b64decode(contents.split(',', 1)[1]).decode('utf-8')
+
+
+@app.callback(
+    Output(component_id='job', component_property='data'),
     [Input(component_id='population', component_property='value'),
      Input(component_id='date-of-first-infection', component_property='value'),
      Input(component_id='date-of-lockdown', component_property='value'),
@@ -154,15 +202,17 @@ def update_output_div(input_value):
      Input(component_id='vents-units-start', component_property='value'),
      Input(component_id='vents-units-shipment-1', component_property='value'),
      Input(component_id='vents-date-shipment-1', component_property='value'),
-     # vis
-     Input(component_id='y-axis-toggle', component_property='value'),
+     # the schedule is applied with its button or by an upload, not on every keystroke
+     Input(component_id='vents-schedule-apply', component_property='n_clicks'),
+     Input(component_id='vents-schedule-upload', component_property='contents'),
      ],
+    [State(component_id='vents-schedule', component_property='value')],
 )
-# Step 3. Run the model in a callback function
-def update_line_plot(pop, date_of_first_infection, date_of_lockdown,
+# Step 3. Run the model in a background job, poll_line_plot picks up the result
+def submit_line_plot(pop, date_of_first_infection, date_of_lockdown,
                      intensive_units, mean_days_icu,
-                     vents_units_start, vents_units_sh1, vents_date_sh1,
-                     y_axis_toggle):
+                     vents_units_start, vents_units_sh1, vents_date_sh1, apply_clicks, upload,
+                     vents_schedule):
 
 
 
@@ -184,40 +234,162 @@ def update_line_plot(pop, date_of_first_infection, date_of_lockdown,
     except ValueError:
         print('Bad date supplied for date of first vents shipment.')
 
-    if y_axis_toggle == False:
-        y_axis_scale = 'log'
+    job = {}
+    if isinstance(date_of_first_infection, datetime) and isinstance(date_of_lockdown, datetime):
+        # lets update_observed recompute the model deaths once the job result expired
+        job['epidemic'] = [pop, date_of_first_infection.strftime('%Y-%m-%d'), date_of_lockdown.strftime('%Y-%m-%d')]
+
+    if upload is not None and any(t['prop_id'] == 'vents-schedule-upload.contents'
+                                  for t in dash.callback_context.triggered):
+        vents_schedule = decode_upload(upload)  # the textarea is filled by load_vents_schedule meanwhile
+
+    if vents_schedule and vents_schedule.strip():
+        try:
+            vents_schedule = SupplySchedule.from_text(vents_schedule, start=vents_units_start)
+        except ValueError as e:  # shown in job-status by poll_line_plot, the plot keeps the last good run
+            return dict(job, key=None, error='Bad ventilator schedule: %s' % e)
     else:
-        y_axis_scale = 'linear'
+        vents_schedule = None
+
+    key = jobs.submit(run_line_plot, (pop, date_of_first_infection, date_of_lockdown,
+                                      intensive_units, mean_days_icu,
+                                      vents_units_start, vents_units_sh1, vents_date_sh1, vents_schedule,
+                                      ))
+    return dict(job, key=key)
+
+
+@app.callback(
+    [Output(component_id='trace-updates', component_property='data'),
+     Output(component_id='trace-hashes', component_property='data'),
+     Output(component_id='job-status', component_property='children'),
+     Output(component_id='job-poll', component_property='disabled')],
+    [Input(component_id='job', component_property='data'),
+     Input(component_id='job-poll', component_property='n_intervals')],
+    [State(component_id='trace-hashes', component_property='data')],
+)
+def poll_line_plot(job, n_intervals, hashes):
+    if job is None:
+        raise PreventUpdate
+    if job.get('error'):
+        return dash.no_update, dash.no_update, job['error'], True
+    status = jobs.status(job['key'])
+    if status['state'] == 'queued':
+        return dash.no_update, dash.no_update, 'Queued, %i runs ahead ...' % status['ahead'], False
+    if status['state'] == 'running':
+        return dash.no_update, dash.no_update, 'Running model ... %.1f s' % status['elapsed'], False
+    if status['state'] == 'failed':
+        return dash.no_update, dash.no_update, 'Model run failed: %s' % status['error'], True
+    if status['state'] == 'unknown':  # expired before it was picked up
+        return dash.no_update, dash.no_update, 'Model run expired, change an input to run again.', True
+    return trace_updates(status['result'], hashes or {}), status['result']['hashes'], '', True
+
+
+def trace_updates(series, hashes):
+    # only the dates and traces whose content differs from what the browser has (hashes), the clientside
+    # callback merges them into the figure - there is no Patch in this Dash version
+    updates = {'names': series['names'], 'colors': series['colors'], 'y': {}}
+    if hashes.get('x') != series['hashes']['x']:
+        updates['x'] = series['x']
+    for name in series['names']:
+        if hashes.get(name) != series['hashes'][name]:
+            updates['y'][name] = series['y'][name]
+    return updates
 
-    df = run_SEIR(pop, date_of_first_infection, date_of_lockdown,
-                  intensive_units, mean_days_icu,
-                  vents_units_start, vents_units_sh1, vents_date_sh1,
-                  )
 
-    groups = df.groupby(by='type')
+def run_line_plot(run_SEIR_args):
+    # job: model run and plot series, both in the worker process, plus the model's deaths to align observed data
+    series = line_plot_series(run_SEIR_wide(*run_SEIR_args))
+    series['deaths'] = observed.expected_deaths(run_epidemic(*run_SEIR_args[:3]).R)
+    return series
 
+
+def line_plot_series(result):
+    # x and one y per trace straight from the model's columns, with content hashes to send only traces that changed
+    names = sorted(result)
     colors = ['red', 'blue', 'orange', 'green', 'cyan']
-    data = []
-    for group, dataframe in groups:
-        dataframe = dataframe.sort_values(by=['date'])
-        trace = go.Scatter(x=dataframe['date'],
-                           y=dataframe['count'],
-                           marker=dict(color=colors[len(data)]),
-                           name=group)
-        data.append(trace)
-
-    layout = go.Layout(xaxis={'title': 'Time'},
-                       yaxis={'title': 'count'},
-                       margin={'l': 40, 'b': 40, 't': 50, 'r': 50},
-                       hovermode='closest',
-                       width=1200,
-                       height=800)
-
-    figure = go.Figure(data=data, layout=layout)
-    figure.update_layout(yaxis_type=f"{y_axis_scale}")
-
-    return figure
+    series = {'names': names, 'colors': colors[:len(names)], 'y': {}, 'hashes': {}}
+    for name in names:
+        y = np.asarray(result[name], dtype=float)
+        series['y'][name] = y
+        series['hashes'][name] = hashlib.sha1(y.tobytes()).hexdigest()
+    x = np.datetime_as_string(result.dates.values, unit='D')
+    series['x'] = x
+    series['hashes']['x'] = hashlib.sha1(x.tobytes()).hexdigest()
+    return series
+
 
+@app.callback(
+    Output(component_id='observed-region', component_property='options'),
+    [Input(component_id='observed-region', component_property='search_value')],
+    [State(component_id='observed-region', component_property='value')],
+)
+def observed_region_options(search_value, value):
+    # options from the shared cache, filtered while typing so the dropdown never gets all regions at once
+    try:
+        options = observed.region_options()
+    except Exception as e:
+        print('No observed data:', e)
+        return []
+    if not search_value:
+        return [o for o in options if '|' not in o['value'] or o['value'] == value]
+    search_value = search_value.lower()
+    return [o for o in options if search_value in o['label'].lower() or o['value'] == value]
+
+
+@app.callback(
+    Output(component_id='observed-traces', component_property='data'),
+    [Input(component_id='observed-region', component_property='value'),
+     Input(component_id='trace-hashes', component_property='data')],
+    [State(component_id='job', component_property='data')],
+)
+def update_observed(region, hashes, job):
+    if not region:
+        return {'traces': []}
+    status = jobs.status(job['key']) if job and job['key'] else {'state': 'unknown'}
+    if status['state'] in ('queued', 'running'):  # trace-hashes changes again when the run is done
+        raise PreventUpdate
+    if status['state'] == 'done':
+        deaths = status['result']['deaths']
+    elif job and job.get('epidemic'):  # result expired or no run: the trajectory is cached, recompute the deaths
+        population, date_of_first_infection, date_of_lockdown = job['epidemic']
+        deaths = observed.expected_deaths(run_epidemic(population, datetime.strptime(date_of_first_infection, '%Y-%m-%d'),
+                                                       datetime.strptime(date_of_lockdown, '%Y-%m-%d')).R)
+    else:
+        raise PreventUpdate
+    return {'traces': observed_traces(region, deaths, np.datetime64(job['epidemic'][1], 'D') if job.get('epidemic')
+                                      else np.datetime64(status['result']['x'][0], 'D'))}
+
+
+def observed_traces(region, deaths, first_day):
+    # observed cases and deaths moved onto the model dates (day 0: first_day) by the offset that matches the
+    # deaths curves best, downsampled server side when the data is long
+    XCDR_data = observed.region_series(region)
+    try:
+        start = first_day + shared.get_offset_X(XCDR_data, deaths)
+    except (ValueError, AssertionError):  # data longer than the model run or with gaps, show it at its own dates
+        start = np.datetime64(XCDR_data[0, 0], 'D')
+    shift = (start - np.datetime64(XCDR_data[0, 0], 'D')).astype(int)
+    label = region.replace('|', ' / ')
+    traces = []
+    for name, column, color in (('observed cases', 1, 'purple'), ('observed deaths', 2, 'black')):
+        y = XCDR_data[:, column].astype(float)
+        keep = observed.lttb(np.arange(len(y)), y, shared.OBSERVED_MAX_POINTS)
+        traces.append({'type': 'scatter', 'mode': 'markers', 'legendgroup': 'observed',
+                       'name': '%s %s (%+i days)' % (label, name, shift),
+                       'x': np.datetime_as_string(start + keep, unit='D'), 'y': y[keep],
+                       'marker': {'color': color, 'size': 4}})
+    return traces
+
+
+# merge trace updates and observed traces and switch the y axis in the browser, the toggle never reaches the server
+app.clientside_callback(
+    ClientsideFunction(namespace='line_plot', function_name='update'),
+    Output(component_id='line-plot', component_property='figure'),
+    [Input(component_id='trace-updates', component_property='data'),
+     Input(component_id='observed-traces', component_property='data'),
+     Input(component_id='y-axis-toggle', component_property='value')],
+    [State(component_id='line-plot', component_property='figure')],
+)
 
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -0,0 +1,35 @@
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    line_plot: {
+        // merge the traces sent by poll_line_plot into the current figure, keep the ones that did not
+        // change, append the observed traces and set the y axis type from the linear / log toggle
+        update: function(updates, observed, linear, figure) {
+            figure = figure || {data: [], layout: {}};
+            var traces = {};
+            var data = (figure.data || []).filter(function(trace) {
+                return trace.legendgroup !== 'observed';
+            });
+            data.forEach(function(trace) {
+                traces[trace.name] = trace;
+            });
+            if (updates) {
+                data = updates.names.map(function(name, i) {
+                    var trace = Object.assign({type: 'scatter', name: name}, traces[name],
+                                              {marker: {color: updates.colors[i]}});
+                    if (updates.x) {
+                        trace.x = updates.x;
+                    }
+                    if (name in updates.y) {
+                        trace.y = updates.y[name];
+                    }
+                    return trace;
+                });
+            }
+            if (observed) {
+                data = data.concat(observed.traces);
+            }
+            var layout = Object.assign({}, figure.layout);
+            layout.yaxis = Object.assign({}, layout.yaxis, {type: linear ? 'linear' : 'log'});
+            return {data: data, layout: layout};
+        }
+    }
+});
@@ -0,0 +1,155 @@
+"""Run a table of scenarios through model.run_SEIR_wide without the dashboard.
+
+The scenario table (CSV or Parquet) has one row per parameter set: scenario_id plus the run_SEIR
+arguments population, date_of_first_infection, date_of_lockdown, intensive_units, mean_days_icu,
+vents_units_start, vents_units_sh1 and vents_date_sh1. Rows are read in chunks and run in a process
+pool; every worker writes each result straight to out_dir/scenario_id=<id>/result.npz (or .parquet),
+so neither the parent nor the workers hold more than a chunk. Results are written atomically, a
+rerun skips the scenarios that already have a result and retries the ones that failed. Dates are
+YYYY-MM-DD or MM-DD-YYYY (the dashboard's), a row with a date in neither format fails on its own.
+
+usage: python batch.py [--format npz|parquet] [--chunk-size N] [--workers N] scenarios.csv out_dir
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import model
+
+COLUMNS = ['scenario_id', 'population', 'date_of_first_infection', 'date_of_lockdown', 'intensive_units',
+           'mean_days_icu', 'vents_units_start', 'vents_units_sh1', 'vents_date_sh1']
+DATE_COLUMNS = ['date_of_first_infection', 'date_of_lockdown', 'vents_date_sh1']
+DATE_FORMATS = ('%Y-%m-%d', '%m-%d-%Y')
+FORMATS = ('npz', 'parquet')
+
+
+def result_path(out_dir, scenario_id, fmt):
+    return os.path.join(out_dir, 'scenario_id=%s' % scenario_id, 'result.' + fmt)
+
+
+def parse_dates(values):
+    """dates in one of DATE_FORMATS, row by row, NaT where none fits"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    dates = pd.to_datetime(values, format=DATE_FORMATS[0], errors='coerce')
+    for date_format in DATE_FORMATS[1:]:
+        dates = dates.fillna(pd.to_datetime(values, format=date_format, errors='coerce'))
+    return dates
+
+
+def read_scenarios(filename, chunk_size):
+    """scenario table in chunks of chunk_size rows, dates parsed (NaT if malformed)"""
+    if filename.endswith('.parquet'):
+        table = pd.read_parquet(filename)  # needs pyarrow or fastparquet
+        chunks = (table.iloc[start:start + chunk_size] for start in range(0, len(table), chunk_size))
+    else:
+        chunks = pd.read_csv(filename, chunksize=chunk_size, dtype={'scenario_id': str})
+    for chunk in chunks:
+        missing = set(COLUMNS) - set(chunk.columns)
+        if missing:
+            raise ValueError("batch: scenario table %s lacks columns %s" % (filename, sorted(missing)))
+        chunk = chunk[COLUMNS].copy()
+        chunk['scenario_id'] = chunk['scenario_id'].astype(str)
+        for column in DATE_COLUMNS:
+            chunk[column] = parse_dates(chunk[column])
+        yield chunk
+
+
+def write_result(result, path, fmt):
+    """write atomically, a result file that exists is complete"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp%i' % os.getpid()
+    if fmt == 'npz':
+        with open(tmp, 'wb') as f:
+            np.savez(f, date=result.dates.values.astype('M8[D]'), **result.series)
+    else:
+        result.to_frame().to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def _run_chunk(args):
+    """run and write one chunk of scenarios in a worker, returns (done, failed) scenario ids"""
+    rows, out_dir, fmt = args
+    done, failed = [], []
+    for row in rows.itertuples(index=False):
+        try:
+            result = model.run_SEIR_wide(int(row.population), row.date_of_first_infection.to_pydatetime(),
+                                         row.date_of_lockdown.to_pydatetime(), int(row.intensive_units),
+                                         int(row.mean_days_icu), int(row.vents_units_start),
+                                         int(row.vents_units_sh1), row.vents_date_sh1.to_pydatetime())
+            write_result(result, result_path(out_dir, row.scenario_id, fmt), fmt)
+            done.append(row.scenario_id)
+        except Exception as e:
+            print("fail: scenario", row.scenario_id, e)
+            failed.append(row.scenario_id)
+    return done, failed
+
+
+def run_batch(filename, out_dir, fmt='npz', chunk_size=50, workers=None, report_every=10.0):
+    """Run every scenario of filename that has no result in out_dir yet, returns a summary dict."""
+    if fmt not in FORMATS:
+        raise ValueError("batch: unknown format '%s', expected one of %s" % (fmt, FORMATS))
+    start = time.monotonic()
+    done, failed, skipped = 0, [], 0
+    last_report = start
+
+    def chunks():
+        nonlocal skipped
+        for chunk in read_scenarios(filename, chunk_size):
+            todo = np.array([not os.path.exists(result_path(out_dir, i, fmt)) for i in chunk['scenario_id']], bool)
+            skipped += int((~todo).sum())
+            bad = todo & chunk[DATE_COLUMNS].isna().any(axis=1).values
+            for scenario_id in chunk['scenario_id'][bad]:
+                print("fail: scenario", scenario_id, "date not in format", ' or '.join(DATE_FORMATS))
+                failed.append(scenario_id)
+            todo &= ~bad
+            if todo.any():
+                yield chunk[todo], out_dir, fmt
+
+    workers = workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = set()
+        source = chunks()
+        while True:
+            # keep the pool busy but never more than 2 chunks per worker in memory
+            while len(pending) < 2 * workers:
+                args = next(source, None)
+                if args is None:
+                    break
+                pending.add(executor.submit(_run_chunk, args))
+            if not pending:
+                break
+            finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                chunk_done, chunk_failed = future.result()
+                done += len(chunk_done)
+                failed += chunk_failed
+            now = time.monotonic()
+            if now - last_report >= report_every:
+                print("%i scenarios done, %i failed, %.1f scenarios/s" % (done, len(failed), done / (now - start)))
+                last_report = now
+
+    seconds = time.monotonic() - start
+    return {'done': done, 'failed': failed, 'skipped': skipped, 'seconds': seconds,
+            'scenarios_per_second': done / seconds if seconds else 0.0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run a scenario table through the SEIR model')
+    parser.add_argument('scenarios', help='CSV or Parquet file, one row per scenario: %s' % ', '.join(COLUMNS))
+    parser.add_argument('out_dir', help='results go to out_dir/scenario_id=<id>/result.<format>')
+    parser.add_argument('--format', choices=FORMATS, default='npz')
+    parser.add_argument('--chunk-size', type=int, default=50, help='scenarios per task')
+    parser.add_argument('--workers', type=int, default=None, help='processes, default: all cores')
+    args = parser.parse_args()
+
+    summary = run_batch(args.scenarios, args.out_dir, args.format, args.chunk_size, args.workers)
+    print("%i scenarios in %.1f s, %.1f scenarios/s, %i already done, %i failed"
+          % (summary['done'], summary['seconds'], summary['scenarios_per_second'], summary['skipped'],
+             len(summary['failed'])))
+    if summary['failed']:
+        print("failed:", ' '.join(summary['failed']), "- run again to retry")
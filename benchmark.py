@@ -0,0 +1,1116 @@
+"""Micro benchmarks for the model and the data pipeline.
+
+usage: python benchmark.py [name ...]   (no name runs all of them)
+
+Every benchmark also checks that the fast code path gives the same result as the
+reference it is timed against, so a run doubles as a regression check.
+"""
+import json
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def report(name, seconds, number):
+    print("%-40s %10.3f ms" % (name, 1000.0 * seconds / number))
+
+
+DEFAULT_INPUTS = (10000000, datetime(2020, 1, 15), datetime(2020, 3, 15),
+                  5000, 5, 5000, 200, datetime(2020, 3, 20))
+
+
+def _legacy_run_SEIR(population, date_of_first_infection, date_of_lockdown,
+                     intensive_units, mean_days_icu,
+                     vents_units_start, vents_units_sh1, vents_date_sh1):
+    """run_SEIR feature engineering as it was before vectorization (per row/cell python calls)"""
+    import model
+    sigma = 1.0 / (5.2 - 2.5)
+    gamma = 1.0 / (2.0 * (4.6 - 1.0 / sigma))
+    icu_rate, vent_rate = (52 / 710), (22 / 56)
+    days_before_lockdown = (date_of_lockdown - date_of_first_infection).days
+    X, S, E, I, R = model.solve(model.model, population, 1, 3.0 * gamma, days_before_lockdown, 1.1 * gamma,
+                                gamma, sigma, 365)
+    df = pd.DataFrame({'days': X, 'susceptible': S, 'exposed': E, 'infectious': I, 'recovered': R})
+    df['date'] = df['days'].apply(lambda x: date_of_first_infection + timedelta(days=x))
+    df['vents'] = df.apply(lambda x: vents_units_start if x['date'] < vents_date_sh1 else (vents_units_start + vents_units_sh1), axis=1)
+    applymap = df.map if hasattr(df, 'map') else df.applymap
+    df = applymap(lambda x: round(x) if isinstance(x, float) else x)
+    df['needs_icu'] = df.apply(lambda x: round(x['infectious'] * icu_rate), axis=1)
+    df['needs_icu'] = df['needs_icu'].shift(10).rolling(window=mean_days_icu, win_type='gaussian').sum(std=3)
+    df.fillna(0, inplace=True)
+    df['needs_ventilator'] = df.apply(lambda x: round(x['needs_icu'] * vent_rate), axis=1)
+    df['needs_ventilator'] = df['needs_ventilator'].shift(3).rolling(window=3, win_type='gaussian').sum(std=3)
+    df.drop(columns=['exposed'], inplace=True)
+    return df.melt(id_vars=['date'], value_vars=['infectious', 'needs_icu', 'vents', 'needs_ventilator'],
+                   value_name='count', var_name='type')
+
+
+@benchmark
+def bench_run_SEIR():
+    import model
+    for mean_days_icu in (1, 5, 14):
+        inputs = DEFAULT_INPUTS[:4] + (mean_days_icu,) + DEFAULT_INPUTS[5:]
+        pd.testing.assert_frame_equal(model.run_SEIR(*inputs), _legacy_run_SEIR(*inputs), check_exact=True)
+
+    number = 20
+    report('run_SEIR legacy (apply/applymap)', timeit.timeit(lambda: _legacy_run_SEIR(*DEFAULT_INPUTS), number=number), number)
+
+    def cold():
+        model.trajectory_cache.clear()
+        model.demand_cache.clear()
+        model.run_SEIR(*DEFAULT_INPUTS)
+    report('run_SEIR vectorized, cold cache', timeit.timeit(cold, number=number), number)
+    report('run_SEIR vectorized, cached', timeit.timeit(lambda: model.run_SEIR(*DEFAULT_INPUTS), number=number), number)
+    shipment_changed = DEFAULT_INPUTS[:6] + (300,) + DEFAULT_INPUTS[7:]
+    report('run_SEIR, only shipment changed', timeit.timeit(lambda: model.run_SEIR(*shipment_changed), number=number), number)
+    print('trajectory cache', model.trajectory_cache.stats())
+    print('demand cache', model.demand_cache.stats())
+
+
+def _random_scenarios(n, seed=0):
+    """population, E0, beta0, days0, beta1, gamma, sigma arrays for n random scenarios"""
+    rng = np.random.default_rng(seed)
+    sigma = 1.0 / (5.2 - 2.5)
+    gamma = 1.0 / (2.0 * (4.6 - 1.0 / sigma))
+    return (rng.uniform(1e5, 3e8, n), np.ones(n), rng.uniform(1.5, 5.0, n) * gamma, rng.integers(20, 120, n),
+            rng.uniform(0.5, 1.5, n) * gamma, np.full(n, gamma), np.full(n, sigma))
+
+
+@benchmark
+def bench_solve_batch():
+    import model
+    n = 200
+    scenarios = _random_scenarios(n)
+    start = timeit.default_timer()
+    reference = np.array([model.solve(model.model, *(a[i] for a in scenarios), 365)[1:] for i in range(n)])
+    report('solve() loop, %i scenarios' % n, timeit.default_timer() - start, 1)
+    peak = np.abs(reference).max(axis=2, keepdims=True)
+    for method, steps_per_day in (('odeint', None), ('rk4', 1), ('rk4', 2), ('rk4', 4), ('rk4', 8)):
+        start = timeit.default_timer()
+        result = model.solve_batch(*scenarios, 365, method=method, steps_per_day=steps_per_day)
+        name = 'solve_batch %s %s, %i scenarios' % (method, steps_per_day or '', n)
+        report(name, timeit.default_timer() - start, 1)
+        print("%-40s %10.1e" % ('  max deviation / peak', (np.abs(result - reference) / peak).max()))
+
+    n = 10000
+    scenarios = _random_scenarios(n)
+    start = timeit.default_timer()
+    model.solve_batch(*scenarios, 365)
+    report('solve_batch rk4 4, %i scenarios' % n, timeit.default_timer() - start, 1)
+
+@benchmark
+def bench_solve():
+    import model
+    n = 50
+    scenarios = _random_scenarios(n)
+    reference = [np.array(model.solve(model.model, *(a[i] for a in scenarios), 365)[1:]) for i in range(n)]
+    number = 20
+    args = tuple(a[0] for a in scenarios)
+    report('solve odeint, per solve', timeit.timeit(lambda: model.solve(model.model, *args, 365), number=number), number)
+    for steps_per_day in (1, 2, 4, 8):
+        seconds = timeit.timeit(lambda: model.solve(model.model, *args, 365, method='rk4-daily',
+                                                    steps_per_day=steps_per_day), number=number)
+        report('solve rk4-daily %i, per solve' % steps_per_day, seconds, number)
+        deviation = max((np.abs(np.array(model.solve(model.model, *(a[i] for a in scenarios), 365, method='rk4-daily',
+                                                     steps_per_day=steps_per_day)[1:]) - reference[i]).max(axis=1)
+                         / np.abs(reference[i]).max(axis=1)).max() for i in range(n))
+        print("%-40s %10.1e" % ('  max deviation / peak', deviation))
+
+@benchmark
+def bench_interventions():
+    import model
+    g = model.gamma
+    schedules = [[(0, 3.0 * g), (60, 0.8 * g), (x, 1.6 * g)] for x in range(100, 250, 2)]
+    for method in ('odeint', 'rk4-daily'):
+        def cold():
+            for schedule in schedules:
+                model.segment_cache.clear()
+                model.solve_piecewise(1e7, 1, schedule, g, model.sigma, 365, method)
+
+        def sweep():
+            model.segment_cache.clear()
+            for schedule in schedules:
+                model.solve_piecewise(1e7, 1, schedule, g, model.sigma, 365, method)
+
+        report('reopen sweep %s, %i dates, uncached' % (method, len(schedules)), timeit.timeit(cold, number=1), 1)
+        report('reopen sweep %s, %i dates, cached' % (method, len(schedules)), timeit.timeit(sweep, number=1), 1)
+
+    # lockdown on / before the first infection and a phase on the lockdown day run like without interventions
+    first, reopen = datetime(2020, 1, 15), datetime(2020, 5, 1)
+    for lockdown in (first, first - timedelta(days=5)):
+        with_phase = model.run_epidemic(1e7, first, lockdown, interventions=[(reopen, 1.5)])
+        without = model.run_epidemic(1e7, first, lockdown)
+        assert np.allclose(with_phase.I[:100], without.I[:100], rtol=1e-6, atol=1e-3)
+    merged = model.run_epidemic(1e7, first, datetime(2020, 3, 15), interventions=[(datetime(2020, 3, 15), 0.5)])
+    same = model.run_epidemic(1e7, first, datetime(2020, 3, 15), r1=0.5)
+    assert np.allclose(merged.I, same.I, rtol=1e-6, atol=1e-3)
+
+
+@benchmark
+def bench_stages():
+    import model
+    import supply
+    population, date_of_first_infection, date_of_lockdown, intensive_units, mean_days_icu = DEFAULT_INPUTS[:5]
+    epidemic = model.run_epidemic(population, date_of_first_infection, date_of_lockdown)
+    model.run_demand(epidemic, mean_days_icu)
+
+    number = 1000
+    report('run_epidemic + run_demand, cached', timeit.timeit(lambda: model.run_demand(
+        model.run_epidemic(population, date_of_first_infection, date_of_lockdown), mean_days_icu), number=number), number)
+    schedule = supply.SupplySchedule([(datetime(2020, 4, 1), 300)], start=5000)
+    report('run_supply', timeit.timeit(lambda: model.run_supply(epidemic.dates, schedule), number=number), number)
+
+
+@benchmark
+def bench_supply_schedule():
+    import supply
+    rng = np.random.default_rng(0)
+    start = np.datetime64('2020-01-15')
+    dates = pd.date_range(datetime(2020, 1, 15), periods=365)
+    for n in (1, 100, 10000):
+        events = [(start + np.timedelta64(int(day), 'D'), int(delta))
+                  for day, delta in zip(rng.integers(0, 365, n), rng.integers(-50, 500, n))]
+        schedule = supply.SupplySchedule(events, start=5000)
+        expected = [5000 + sum(delta for date, delta in events if date <= day) for day in dates[::30]]
+        assert list(schedule.units(dates[::30])) == expected
+        number = 1000
+        report('SupplySchedule.units, %i events' % n, timeit.timeit(lambda: schedule.units(dates), number=number), number)
+
+    # the header the dashboard label asks for is skipped, a bad line is an error
+    for header in ('date, units', 'date,units', 'date,delta', ''):
+        assert list(supply.SupplySchedule.from_text(header + '\n03-20-2020, 200\n04-01-2020, -50').deltas) == [200, -50]
+    for text in ('date, units\nfoo, 5', '03-20-2020, 200\ndate, units'):
+        try:
+            supply.SupplySchedule.from_text(text)
+        except ValueError:
+            continue
+        raise AssertionError('from_text accepted %r' % text)
+
+
+def _messy_tracker_file(path):
+    """small tracker api style json with what the real one has: locations starting on different days,
+    leading zero days, several provinces per country, renamed countries, a shorter recovered list, dates
+    across a year end and history keys out of order"""
+    rng = np.random.default_rng(1)
+    locations = [('Italy', ''), ('Mainland China', 'Hubei'), ('China', 'Beijing'), ('China', ''), ('France', ''),
+                 ('France', 'Reunion'), ('Korea, South', ''), ('US', 'New York'), ('US', 'Texas'),
+                 ('Iran (Islamic Republic of)', ''), ('Niger', ''), ('Nigeria', '')]
+    start = datetime(2019, 12, 20)
+    histories = []
+    for i, (country, province) in enumerate(locations):
+        first, n_days = int(rng.integers(0, 10)), int(rng.integers(40, 60))
+        zeros = int(rng.integers(0, 15))
+        days = [start + timedelta(days=first + j) for j in range(n_days)]
+        order = rng.permutation(n_days) if i % 3 == 0 else np.arange(n_days)
+        histories.append(([days[j].strftime('%-m/%-d/%y') for j in order], order, zeros))
+    d = {}
+    for category, n_locations in (('confirmed', len(locations)), ('deaths', len(locations)), ('recovered', 9)):
+        d[category] = {'locations': []}
+        for (country, province), (keys, order, zeros) in list(zip(locations, histories))[:n_locations]:
+            values = np.cumsum(rng.integers(0, 20, len(keys)))
+            values[:zeros] = 0
+            d[category]['locations'].append({'country': country, 'province': province,
+                                             'history': dict(zip(keys, values[order].tolist()))})
+    with open(path, 'w') as f:
+        json.dump(d, f)
+
+
+def _legacy_get_country_xcdr(d, country='all', province='all', excludeCountries=[], excludeProvinces=[],
+                             dateOffset=0, returnDates=False):
+    """get_country_xcdr as it was before WorldData: one python pass over the parsed json per call"""
+    import dateutil.parser
+    country = '' if country == 'all' else country
+    province = '' if province == 'all' else province
+    dictXYYY = {}
+    XDatesAll = []
+    for i, location in enumerate(d['confirmed']['locations']):
+        if country != '' and location['country'] != country:
+            continue
+        if location['country'] in excludeCountries:
+            continue
+        if province != '' and location['province'] != province:
+            continue
+        if location['province'] in excludeProvinces:
+            continue
+        for date in location['history']:
+            try:
+                recovered = int(d['recovered']['locations'][i]['history'][date])
+            except (KeyError, IndexError):
+                recovered = 0
+            XYYY = dictXYYY.setdefault(dateutil.parser.parse(date), [0, 0, 0])
+            XYYY[0] += int(location['history'][date])
+            XYYY[1] += int(d['deaths']['locations'][i]['history'][date])
+            XYYY[2] += recovered
+            XDatesAll.append(dateutil.parser.parse(date))
+    listXYYY = []
+    for date, (C, D, R) in dictXYYY.items():
+        if (C + D + R) > 0:
+            listXYYY.append((date if returnDates else (date - min(XDatesAll)).days + dateOffset, C, D, R))
+    listXYYY.sort()
+    if len(listXYYY) == 0:
+        raise Exception("get_country_xcdr empty - country '%s' or province '%s' not found?" % (country, province))
+    return listXYYY
+
+
+@benchmark
+def bench_world_data():
+    import contextlib
+    import io
+    import itertools
+    import os
+    import tempfile
+    import shared
+    import world_data
+
+    # get_country_xcdr on the WorldData matrices against the per location scan of the parsed json
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        filename = os.path.join(tmp, 'tracker.json')
+        _messy_tracker_file(filename)
+        with open(filename) as f:
+            text = f.read()
+        for old, new in world_data.RENAMES:
+            text = text.replace(old, new)
+        d = json.loads(text)
+        data, world_data._data = world_data._data, world_data.load_data(filename)
+        try:
+            countries, provinces = world_data.get_countries_provinces()
+            cases = 0
+            for country, province, excludeCountries, excludeProvinces, dateOffset, returnDates in itertools.product(
+                    ['all'] + countries, ['all'] + provinces[1:], [[], ['China'], ['Italy', 'US']],
+                    [[], ['Hubei']], [0, 7], [False, True]):
+                args = (country, province, excludeCountries, excludeProvinces, dateOffset)
+                try:
+                    expected = _legacy_get_country_xcdr(d, *args, returnDates=returnDates)
+                except Exception:
+                    expected = None
+                try:
+                    result = world_data.get_country_xcdr(*args, returnDates=returnDates)
+                except Exception:
+                    result = None
+                assert result == expected, (args, returnDates)
+                cases += expected is not None
+            assert cases > 100, cases
+        finally:
+            world_data._data = data
+
+    number = 5
+    with open(shared.FILENAME) as f:
+        d = json.load(f)
+    report('WorldData.from_json', timeit.timeit(lambda: world_data.WorldData.from_json(d), number=number), number)
+    npy_path, meta_path = world_data._cache_paths(shared.FILENAME)
+    for path in (npy_path, meta_path):  # cold: parse the download and write the cache
+        if os.path.exists(path):
+            os.remove(path)
+    report('load_data (parse, write cache)', timeit.timeit(lambda: world_data.load_data(shared.FILENAME), number=1), 1)
+    report('WorldData.load (memory mapped cache)', timeit.timeit(lambda: world_data.WorldData.load(npy_path, meta_path), number=number), number)
+    countries, provinces = world_data.get_countries_provinces()
+
+    def query_all():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for country in countries:
+                world_data.get_country_xcdr(country, returnDates=True)
+    report('get_country_xcdr, %i countries' % len(countries), timeit.timeit(query_all, number=number), number)
+
+
+@benchmark
+def bench_import():
+    """cold import time in a fresh interpreter (network fetch excluded: the data file must be current)"""
+    import subprocess
+    for statement in ('import world_data', 'import population', 'import model',
+                      'import population; population.get_all_population_data()'):
+        times = []
+        for i in range(3):
+            start = timeit.default_timer()
+            subprocess.run([sys.executable, '-c', statement], check=True, stdout=subprocess.DEVNULL)
+            times.append(timeit.default_timer() - start)
+        report(statement, min(times), 1)
+
+
+def _synthetic_tracker_file(path, n_locations, n_days, n_recovered=None):
+    """tracker api style json: {category: {'locations': [{'country', 'province', 'history'}]}};
+    n_recovered: locations in the recovered list, the tracker's is shorter than the others"""
+    rng = np.random.default_rng(0)
+    keys = [(datetime(2020, 1, 22) + timedelta(days=i)).strftime('%-m/%-d/%y') for i in range(n_days)]
+    with open(path, 'w') as f:
+        f.write('{')
+        for c, category in enumerate(('confirmed', 'deaths', 'recovered')):
+            locations = []
+            for i in range(n_locations if category != 'recovered' or n_recovered is None else n_recovered):
+                values = np.cumsum(rng.integers(0, 50, n_days)).tolist()
+                locations.append({'country': 'Country %i' % (i // 10), 'province': 'Province %i' % i,
+                                  'coordinates': {'lat': '0', 'long': '0'}, 'latest': values[-1],
+                                  'history': dict(zip(keys, values))})
+            f.write('%s"%s": {"locations": %s, "latest": 0}' % (',' if c else '', category, json.dumps(locations)))
+        f.write(', "latest": {}}')
+
+
+@benchmark
+def bench_ingest():
+    """peak memory of json.loads + WorldData.from_json vs. the streaming WorldData.from_stream"""
+    import os
+    import subprocess
+    import tempfile
+    measure = """
+import resource, sys, time, json
+sys.path.insert(0, %r)
+import world_data
+start = time.time()
+with open(%r) as f:
+    {}
+print(time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+    paths = {'json.loads': 'data = world_data.WorldData.from_json(json.loads(f.read()))',
+             'streaming': 'data = world_data.WorldData.from_stream(f)'}
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'tracker.json')
+        _synthetic_tracker_file(filename, 3000, 200)
+        print('synthetic tracker file: %.1f MB' % (os.path.getsize(filename) / 1e6))
+        baseline = subprocess.run([sys.executable, '-c', 'import resource, numpy, dateutil.parser; '
+                                   'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'],
+                                  check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        print('%-40s %10.1f MB' % ('interpreter + numpy', int(baseline.stdout) / 1024))
+        for name, statement in paths.items():
+            code = measure.replace('{}', statement) % (os.path.dirname(os.path.abspath(__file__)), filename)
+            out = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                                 universal_newlines=True).stdout.split('\n')[-2].split()
+            print('%-40s %10.1f MB peak RSS, %.2f s' % (name, int(out[1]) / 1024, float(out[0])))
+
+
+@benchmark
+def bench_refresh():
+    """daily refresh: a download with one more day, rebuilt from scratch vs. appended to the last snapshot"""
+    import contextlib
+    import io
+    import os
+    import tempfile
+    import world_data
+    number = 3
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'tracker.json')
+        _synthetic_tracker_file(filename, 300, 400, n_recovered=250)  # shaped like the tracker's
+        with open(filename) as f:
+            d = json.load(f)
+        for category in ('confirmed', 'deaths', 'recovered'):
+            for location in d[category]['locations']:
+                location['history'] = dict(list(location['history'].items())[:-1])
+        previous = world_data.WorldData.from_json(d)
+        previous.country_totals()
+
+        def ingest(previous=None, log=None):
+            with open(filename) as f, contextlib.redirect_stdout(log or io.StringIO()):
+                data = world_data.WorldData.from_stream(f, previous)
+            data.country_totals()
+            return data
+        log = io.StringIO()
+        full, appended = ingest(), ingest(previous, log)
+        assert 'appended 1 days' in log.getvalue(), log.getvalue()
+        for name in ('dates', 'confirmed', 'deaths', 'recovered', 'first_day'):
+            assert np.array_equal(getattr(full, name), getattr(appended, name)), name
+        assert np.array_equal(full.country_totals()[1], appended.country_totals()[1])
+
+        d['recovered']['locations'][10]['history']['2/1/20'] += 1  # a revised past day rebuilds
+        revised = world_data.WorldData.from_json(d)
+        log = io.StringIO()
+        rebuilt = ingest(revised, log)
+        assert 'history changed' in log.getvalue() and np.array_equal(rebuilt.recovered, full.recovered)
+        print('synthetic tracker file: %.1f MB, 300 locations (250 recovered), 399 + 1 days'
+              % (os.path.getsize(filename) / 1e6))
+        report('full rebuild', timeit.timeit(ingest, number=number), number)
+        report('append to previous snapshot', timeit.timeit(lambda: ingest(previous), number=number), number)
+
+
+def _synthetic_deaths(r0, r1, days_to_data, ifr, lockdown_after_data, n_days, N):
+    """noise free cumulative deaths from the first data day on, the way calibrate models them"""
+    import calibrate
+    import model
+    SEIR = model.solve_batch(np.array([N]), model.E0, np.array([r0 * model.gamma]),
+                             np.array([float(days_to_data + lockdown_after_data)]), np.array([r1 * model.gamma]),
+                             model.gamma, model.sigma, days_to_data + n_days)
+    index = days_to_data + np.arange(n_days) - calibrate.death_lag
+    return ifr * np.where(index >= 0, SEIR[0, 3, np.clip(index, 0, None)], 0.0)
+
+
+@benchmark
+def bench_calibrate():
+    """calibrate.fit recovers known parameters from synthetic deaths, with the lockdown given and fitted"""
+    import calibrate
+    truth = {'r0': 3.2, 'r1': 0.9, 'days_to_data': 40, 'ifr': 0.01, 'lockdown_after_data': 15}
+    N = 6.0e7
+    for n_days in (60, 120):
+        deaths = _synthetic_deaths(n_days=n_days, N=N, **truth)
+        for lockdown in (truth['lockdown_after_data'], None):
+            start = timeit.default_timer()
+            best, loss, iterations, evaluations = calibrate.fit(deaths, N, truth['ifr'], lockdown)
+            seconds = timeit.default_timer() - start
+            r0, r1, days_to_data, log_ifr, lockdown_after_data = best
+            print('%i days, lockdown %-6s r0 %.2f  r1 %.2f  first infection %+.1f d  lockdown %+.1f d  loss %.1e  '
+                  '%i iterations' % (n_days, 'given' if lockdown else 'fitted', r0, r1,
+                                     days_to_data - truth['days_to_data'],
+                                     lockdown_after_data - truth['lockdown_after_data'], loss, iterations))
+            assert abs(r0 - truth['r0']) < 0.15 and abs(r1 - truth['r1']) < 0.2, (r0, r1)
+            assert abs(days_to_data - truth['days_to_data']) <= 2.5, days_to_data
+            assert abs(lockdown_after_data - truth['lockdown_after_data']) <= 3, lockdown_after_data
+            report('calibrate.fit, %i days, lockdown %s' % (n_days, 'given' if lockdown else 'fitted'), seconds, 1)
+
+    # IFR and the first infection trade off against each other: the fit is good, the IFR is not the true one
+    deaths = _synthetic_deaths(n_days=60, N=N, **truth)
+    best, loss, iterations, evaluations = calibrate.fit(deaths, N, None, truth['lockdown_after_data'])
+    print('IFR fitted too: IFR %.4f (true %.4f), first infection %+.1f d, loss %.1e'
+          % (10 ** best[3], truth['ifr'], best[2] - truth['days_to_data'], loss))
+
+
+class _TrackerStandIn:
+    """local stand in for the tracker api: ETag / 304, gzip on request, optional slow or short answers"""
+
+    def __init__(self, body):
+        import gzip
+        import http.server
+        import threading
+        self.body, self.gzipped = body, gzip.compress(body)
+        self.requests, self.downloads = 0, 0
+        self.delay, self.short, self.gzip = 0.0, False, True
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                import time
+                stand_in.requests += 1
+                time.sleep(stand_in.delay)
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                stand_in.downloads += 1
+                gzipped = stand_in.gzip and 'gzip' in self.headers.get('Accept-Encoding', '')
+                body = stand_in.gzipped if gzipped else stand_in.body
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                if gzipped:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2] if stand_in.short else body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%i/all' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@benchmark
+def bench_fetch():
+    """fetch_data against a local stand in server: 304, gzip, atomic replace, one download for many workers"""
+    import contextlib
+    import gzip
+    import io
+    import os
+    import tempfile
+    import threading
+    import fetch_data
+    import shared
+    import world_data
+    body = json.dumps({'confirmed': {'locations': [{'history': {str(i): i for i in range(500)}}]}}).encode()
+    server = _TrackerStandIn(body)
+    quiet = contextlib.redirect_stdout(io.StringIO())
+    try:
+        with tempfile.TemporaryDirectory() as tmp, quiet:
+            filename = os.path.join(tmp, 'data.json')
+
+            assert fetch_data.fetch(server.url, filename)  # gzip download, decoded on the fly
+            with open(filename, 'rb') as f:
+                assert f.read() == body
+            assert not fetch_data.fetch(server.url, filename)  # If-None-Match -> 304, file kept
+            assert server.downloads == 1 and server.requests == 2
+            assert not fetch_data.is_stale(filename, max_age=60)
+
+            os.remove(fetch_data._meta_path(filename))  # no ETag: the next fetch downloads again
+            server.short = True  # connection closes halfway: the old file stays, no temp file is left
+            for accept_gzip in (True, False):
+                try:
+                    if not accept_gzip:
+                        server.gzip = False
+                    fetch_data.fetch(server.url, filename)
+                    raise AssertionError('fetch accepted a truncated download')
+                except fetch_data.FetchError:
+                    pass
+            server.short, server.gzip = False, True
+            with open(filename, 'rb') as f:
+                assert f.read() == body
+            assert sorted(os.listdir(tmp)) == ['data.json', 'data.json.lock']
+
+            server.delay = 2.0  # hung server: fetch gives up after its timeout and releases the lock
+            try:
+                fetch_data.fetch(server.url, filename, timeout=0.2)
+                raise AssertionError('fetch did not time out')
+            except OSError:
+                pass
+            server.delay = 0.2
+
+            os.utime(filename, (0, 0))  # stale: several workers refresh at once, one downloads
+            downloads = server.downloads
+            workers = [threading.Thread(target=fetch_data.fetch, args=(server.url, filename, 60)) for _ in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            assert server.downloads == downloads + 1, server.downloads - downloads
+            server.delay = 0.0
+
+        # world_data.load() keeps serving the last download when the refresh breaks off
+        filename, url, data = shared.FILENAME, shared.APIURL, world_data._data
+        with tempfile.TemporaryDirectory() as tmp, quiet:
+            shared.FILENAME = os.path.join(tmp, 'tracker.json')
+            _synthetic_tracker_file(shared.FILENAME, 20, 30)
+            with open(shared.FILENAME, 'rb') as f:
+                tracker = _TrackerStandIn(f.read())
+            shared.APIURL = tracker.url
+            try:
+                world_data._data = None
+                before = world_data.load()
+                for short, too_small in ((True, False), (False, True)):
+                    tracker.short = short
+                    if too_small:
+                        tracker.body, tracker.gzipped = b'{}', gzip.compress(b'{}')
+                    os.utime(shared.FILENAME, (0, 0))
+                    assert fetch_data.is_stale(shared.FILENAME)
+                    after = world_data.load()
+                    assert after.dates[-1] == before.dates[-1] and np.array_equal(after.confirmed, before.confirmed)
+                assert tracker.downloads == 2
+            finally:
+                tracker.close()
+                shared.FILENAME, shared.APIURL, world_data._data = filename, url, data
+
+        with tempfile.TemporaryDirectory() as tmp, quiet:
+            filename = os.path.join(tmp, 'data.json')
+            fetch_data.fetch(server.url, filename)
+            number = 50
+            seconds = timeit.timeit(lambda: fetch_data.fetch(server.url, filename), number=number)
+        report('fetch, not modified (304)', seconds, number)
+    finally:
+        server.close()
+
+
+def _legacy_offset(D_data, D_model):
+    """shared.get_offset_X search loop before vectorization"""
+    mini, miniO = 9e9, None
+    for o in range(0, 150):
+        oDd = np.pad(D_data, (o, 0))
+        oDm = D_model[:len(D_data) + o]
+        rms = np.sqrt(np.mean(np.square((oDd - oDm)) / (1 + oDm)))
+        if rms < mini:
+            mini, miniO = rms, o
+    return miniO
+
+
+@benchmark
+def bench_offset():
+    import shared
+    rng = np.random.default_rng(0)
+    D_models = np.cumsum(rng.uniform(0, 50, (50, 365)), axis=1)
+    D_data_list = [np.cumsum(rng.uniform(0, 50, n)) for n in rng.integers(20, 200, 180)]
+    for D_data in D_data_list[:20]:
+        offsets, scores = shared.offset_scores(D_data, D_models[0])
+        assert offsets[np.argmin(scores)] == _legacy_offset(D_data, D_models[0])
+
+    number = 20
+    report('offset search, python loop', timeit.timeit(lambda: _legacy_offset(D_data_list[0], D_models[0]), number=number), number)
+    report('offset search, vectorized', timeit.timeit(lambda: shared.offset_scores(D_data_list[0], D_models[0]), number=number), number)
+    start = timeit.default_timer()
+    shared.get_offsets_batch(D_data_list, D_models)
+    report('get_offsets_batch, 180 series x 50 runs', timeit.default_timer() - start, 1)
+
+@benchmark
+def bench_ensemble():
+    import os
+    import ensemble
+    import model
+    import supply
+    rng = np.random.default_rng(0)
+    pinned = ensemble.sample_parameters(50, rng, {'icu_rate': ensemble.DISTRIBUTIONS['icu_rate']})
+    assert np.ptp(pinned['icu_rate']) > 0 and all(np.all(pinned[name] == getattr(model, name))
+                                                  for name in ensemble.DISTRIBUTIONS if name != 'icu_rate')
+    # zero width distributions are the model.py values: the samples reproduce model.demand
+    zero_width = {name: ('uniform', (getattr(model, name),) * 2) for name in ensemble.DISTRIBUTIONS}
+    needs_icu, needs_ventilator = ensemble.simulate(ensemble.sample_parameters(3, rng, zero_width), 80e6, 60, 10)
+    X, S, E, I, R = model.solve(model.model, 80e6, model.E0, model.r0 * model.gamma, 60, model.r1 * model.gamma,
+                                model.gamma, model.sigma, model.days_total)
+    expected = model.demand(I, 10)
+    for samples, series in ((needs_icu, expected.needs_icu), (needs_ventilator, expected.needs_ventilator)):
+        series = np.nan_to_num(series)
+        assert np.max(np.abs(samples - series)) < 1e-4 * series.max()
+
+    schedule = supply.SupplySchedule([(datetime(2020, 4, 20), 2000)], start=1000)
+    args = (80e6, datetime(2020, 1, 20), datetime(2020, 3, 20), 10, schedule)
+    ensemble.run_ensemble(*args, n=100)
+    for n in (1000, 4000):
+        start = timeit.default_timer()
+        ensemble.run_ensemble(*args, n=n)
+        report('ensemble %i samples, in process' % n, timeit.default_timer() - start, 1)
+    workers = os.cpu_count()
+    start = timeit.default_timer()
+    ensemble.run_ensemble(*args, n=4000, workers=workers)
+    report('ensemble 4000 samples, %i workers' % workers, timeit.default_timer() - start, 1)
+
+@benchmark
+def bench_hospital_model():
+    import hospital_model
+    import model
+    # one group without capacity limits is the SEIR of model.py, the hospital compartments split its R
+    Y = hospital_model.solve(1e7, 1, 3.0, 1.1, 60, 365, np.inf, np.inf, 10)[:, 0]
+    X, S, E, I, R = model.solve(model.model, 1e7, 1, 3.0 * model.gamma, 60, 1.1 * model.gamma, model.gamma,
+                                model.sigma, 365)
+    H, D = hospital_model.H, hospital_model.D
+    for series, expected in ((Y[hospital_model.S], S), (Y[hospital_model.E], E), (Y[hospital_model.I], I),
+                             (Y[H:].sum(axis=0), R)):
+        assert np.max(np.abs(series - expected)) < 1e-6 * np.max(expected)
+    # no ICU beds: more deaths than with unlimited capacity
+    limited = hospital_model.solve(1e7, 1, 3.0, 1.1, 60, 365, 0, np.inf, 10)[D, 0]
+    assert np.all(limited >= Y[D] - 1e-6) and limited[-1] > Y[D, -1]
+
+    rng = np.random.default_rng(0)
+    for G in (1, 10, 100, 500):
+        groups = hospital_model.AgeGroups(tuple(range(G)), rng.uniform(1, 2, G), rng.uniform(0, 5, (G, G)),
+                                          rng.uniform(0.1, 3, G))
+        start = timeit.default_timer()
+        hospital_model.solve(1e7, 1, 3.0, 1.1, 60, 365, 2000, 1000, 10, groups=groups)
+        report('hospital_model.solve, %i groups' % G, timeit.default_timer() - start, 1)
+
+@benchmark
+def bench_regions():
+    import model
+    import regions
+    import supply
+    rng = np.random.default_rng(0)
+    # whole ventilators for whole demand: without transfer time the unmet demand is the lower bound
+    needs = np.round(rng.uniform(0, 30, (20, 1)) * np.sin(np.linspace(0, np.pi, 120)) ** 2)
+    holdings = rng.integers(0, 10, 20).astype(float)
+    stockpile = np.repeat([50.0, 150.0, 300.0], 40)
+    vents, unmet = regions.allocate(needs, stockpile, holdings, transfer_days=0)
+    lower_bound = np.maximum(0, needs.sum(axis=0) - stockpile - holdings.sum())
+    assert lower_bound.max() > 0 and np.allclose(unmet.sum(axis=0), lower_bound)
+    for transfer_days in (0, 1, 3):  # nothing is lost or made up, no region holds a negative amount
+        for t, (held, transit, pool) in enumerate(regions._allocation_days(needs, stockpile, holdings,
+                                                                           transfer_days)):
+            assert np.isclose(held.sum() + transit.sum() + pool, stockpile[t] + holdings.sum())
+            assert held.min() >= 0 and transit.min() >= 0 and pool >= 0
+
+    schedule = supply.SupplySchedule([(datetime(2020, 3, 1), 100000)])
+    for n in (10, 100, 1000, 3000):
+        N = rng.uniform(1e4, 1e6, n)
+        E0 = (rng.uniform(size=n) < 0.1).astype(float)
+        flows = [(i, j, 0.002) for i in range(n) for j in rng.choice(n, 5) if i != j]
+        mobility = regions.mobility_matrix(flows, n)
+        start = timeit.default_timer()
+        regions.simulate(N, E0, 3 * model.gamma, 60, 1.1 * model.gamma, 365, mobility)
+        report('regions.simulate coupled, %i regions' % n, timeit.default_timer() - start, 1)
+        start = timeit.default_timer()
+        regions.run_regions(range(n), N, datetime(2020, 1, 1), datetime(2020, 3, 1), 10, schedule,
+                            holdings=np.full(n, 20), mobility=mobility, E0=E0)
+        report('regions.run_regions, %i regions' % n, timeit.default_timer() - start, 1)
+
+def _percentiles(values):
+    return '  p50 %7.1f ms   p95 %7.1f ms' % tuple(1000 * np.percentile(values, [50, 95]))
+
+
+@benchmark
+def bench_jobs():
+    import concurrent.futures
+    import threading
+    import time
+    import app
+    import jobs
+    import model
+    import shared
+    users, runs, threads = 16, 3, 8
+    # every user runs its own scenarios, pairs of users share theirs (duplicate requests)
+    scenarios = [[(10000000 + 1000 * (user // 2) + run,) + DEFAULT_INPUTS[1:] for run in range(runs)]
+                 for user in range(users)]
+
+    # current setup: a gunicorn sync worker answers one request at a time and runs the model in it
+    worker = threading.Lock()
+
+    def sync_user(user):
+        latencies = []
+        for args in scenarios[user]:
+            start = time.monotonic()
+            with worker:
+                _legacy_figure(model.run_SEIR(*args), 'log')
+            latencies.append(time.monotonic() - start)
+        return latencies, latencies
+
+    # jobs: one gunicorn worker with 8 threads (Procfile) submits and polls, the pool runs model and figure
+    queue = jobs.JobQueue(workers=shared.JOB_WORKERS)
+    server_threads = threading.Semaphore(threads)
+
+    def async_user(user):
+        requests, results = [], []
+        for args in scenarios[user]:
+            start = time.monotonic()
+            with server_threads:
+                key = queue.submit(app.run_line_plot, args)
+            requests.append(time.monotonic() - start)
+            while True:
+                time.sleep(0.25)  # dcc.Interval
+                poll = time.monotonic()
+                with server_threads:
+                    state = queue.status(key)['state']
+                requests.append(time.monotonic() - poll)
+                if state in ('done', 'failed'):
+                    break
+            results.append(time.monotonic() - start)
+        return requests, results
+
+    queue.wait(queue.submit(app.run_line_plot, DEFAULT_INPUTS))  # start the pool
+    for name, user in (('sync', sync_user), ('jobs', async_user)):
+        model.trajectory_cache.clear()
+        model.demand_cache.clear()
+        with concurrent.futures.ThreadPoolExecutor(users) as pool:
+            measured = list(pool.map(user, range(users)))
+        print('%-6s %i users x %i runs  request latency%s' % (name, users, runs,
+                                                              _percentiles(sum((m[0] for m in measured), []))))
+        print('%-6s %i users x %i runs  time to figure %s' % (name, users, runs,
+                                                              _percentiles(sum((m[1] for m in measured), []))))
+    print(queue.stats())
+
+    # a pool process killed (OOM): the job fails, the next submit gets a new pool; failures are not reused
+    assert queue.wait(queue.submit(_kill_worker, 'oom'))['state'] == 'failed'
+    time.sleep(0.1)
+    assert queue.wait(queue.submit(app.run_line_plot, DEFAULT_INPUTS[:-1] + (datetime(2020, 3, 21),)))['state'] == 'done'
+    submitted = queue.stats()['submitted']
+    assert queue.wait(queue.submit(_kill_worker, 'oom'))['state'] == 'failed'
+    assert queue.stats()['submitted'] == submitted + 1 and queue.stats()['restarts'] == 1
+    queue.shutdown()
+
+
+def _kill_worker(reason):
+    import os
+    import signal
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def _legacy_figure(df, y_axis_scale):
+    """figure as app.update_line_plot built it on every callback before the trace updates"""
+    import plotly.graph_objs as go
+    data = []
+    colors = ['red', 'blue', 'orange', 'green', 'cyan']
+    for group, dataframe in df.groupby(by='type'):
+        dataframe = dataframe.sort_values(by=['date'])
+        data.append(go.Scatter(x=dataframe['date'], y=dataframe['count'], marker=dict(color=colors[len(data)]),
+                               name=group))
+    layout = go.Layout(xaxis={'title': 'Time'}, yaxis={'title': 'count'},
+                       margin={'l': 40, 'b': 40, 't': 50, 'r': 50}, hovermode='closest', width=1200, height=800)
+    figure = go.Figure(data=data, layout=layout)
+    figure.update_layout(yaxis_type=y_axis_scale)
+    return figure
+
+
+@benchmark
+def bench_callbacks():
+    """server callbacks and response bytes for one session: type a population, flip the y axis twice,
+    type a shipment size"""
+    import time
+    import plotly
+    import app
+    import model
+    inputs = {'population': '10000000', 'date-of-first-infection': '01-15-2020', 'date-of-lockdown': '03-15-2020',
+              'intensive-units': '5000', 'mean_days_icu': '5', 'vents-units-start': '5000',
+              'vents-units-shipment-1': '200', 'vents-date-shipment-1': '03-20-2020'}
+    session = [('population', '20000000'), ('y-axis-toggle', True), ('y-axis-toggle', False),
+               ('vents-units-shipment-1', '300')]
+
+    # before: every keystroke and every toggle re-ran the model and sent the whole figure
+    calls, sent = 1, 0
+    values, linear = dict(inputs), False
+    sent += len(json.dumps(_legacy_figure(model.run_SEIR(*DEFAULT_INPUTS), 'log'), cls=plotly.utils.PlotlyJSONEncoder))
+    for field, value in session:
+        if field == 'y-axis-toggle':
+            linear, keystrokes = value, [value]
+        else:
+            keystrokes = [value[:i] for i in range(1, len(value) + 1)]
+        for keystroke in keystrokes:
+            if field != 'y-axis-toggle':
+                values[field] = keystroke
+            args = (int(values['population']),) + DEFAULT_INPUTS[1:5] + (int(values['vents-units-shipment-1']),) + \
+                DEFAULT_INPUTS[6:]
+            figure = _legacy_figure(model.run_SEIR(*args), 'linear' if linear else 'log')
+            calls += 1
+            sent += len(json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder))
+    print('%-40s %6i callbacks %9i bytes' % ('full figure per keystroke', calls, sent))
+
+    # now: debounced inputs submit once per field, polls return changed traces, the toggle stays in the browser
+    client = app.server.test_client()
+    counts = {'calls': 0, 'bytes': 0}
+
+    def post(output, outputs, inputs, state=()):
+        response = client.post('/_dash-update-component', json={
+            'output': output, 'outputs': outputs, 'changedPropIds': [],
+            'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+            'state': [{'id': i, 'property': p, 'value': v} for i, p, v in state]})
+        counts['calls'] += 1
+        counts['bytes'] += len(response.data)
+        return json.loads(response.data)['response']
+
+    def run(values, hashes):
+        job = post('job.data', {'id': 'job', 'property': 'data'},
+                   [(k, 'value', v) for k, v in values.items()]
+                   + [('vents-schedule-apply', 'n_clicks', None), ('vents-schedule-upload', 'contents', None)],
+                   [('vents-schedule', 'value', '')])['props']['data']
+        for n in range(1000):
+            response = post('..trace-updates.data...trace-hashes.data...job-status.children...job-poll.disabled..',
+                            [{'id': 'trace-updates', 'property': 'data'}, {'id': 'trace-hashes', 'property': 'data'},
+                             {'id': 'job-status', 'property': 'children'}, {'id': 'job-poll', 'property': 'disabled'}],
+                            [('job', 'data', job), ('job-poll', 'n_intervals', n)], [('trace-hashes', 'data', hashes)])
+            if response['job-poll']['disabled']:
+                return response.get('trace-hashes', {}).get('data', hashes)
+            time.sleep(0.25)  # dcc.Interval
+
+    values = dict(inputs)
+    app.jobs.wait(app.jobs.submit(app.run_line_plot, DEFAULT_INPUTS))  # start the pool
+    counts['calls'] = counts['bytes'] = 0
+    hashes = run(values, None)
+    for field, value in session:
+        if field != 'y-axis-toggle':  # clientside
+            values[field] = value
+            hashes = run(values, hashes)
+    print('%-40s %6i callbacks %9i bytes' % ('debounced, trace updates', counts['calls'], counts['bytes']))
+    app.jobs.shutdown()
+
+def _legacy_series(df):
+    """plot series from run_SEIR's long frame, the groupby / sort app.py did before SEIRResult"""
+    series = {}
+    for group, dataframe in df.groupby(by='type'):
+        dataframe = dataframe.sort_values(by=['date'])
+        series[group] = dataframe['count'].values.astype(float)
+    return dataframe['date'].values, series
+
+
+@benchmark
+def bench_result():
+    import app
+    import model
+    model.run_SEIR(*DEFAULT_INPUTS)  # model stages cached, only the reshaping is timed
+    dates, legacy = _legacy_series(model.run_SEIR(*DEFAULT_INPUTS))
+    series = app.line_plot_series(model.run_SEIR_wide(*DEFAULT_INPUTS))
+    assert all(np.array_equal(legacy[name], series['y'][name], equal_nan=True) for name in legacy)
+    assert (np.datetime_as_string(dates, unit='D') == series['x']).all()
+
+    number = 200
+    report('run_SEIR + melt + groupby/sort', timeit.timeit(
+        lambda: _legacy_series(model.run_SEIR(*DEFAULT_INPUTS)), number=number), number)
+    report('run_SEIR_wide + line_plot_series', timeit.timeit(
+        lambda: app.line_plot_series(model.run_SEIR_wide(*DEFAULT_INPUTS)), number=number), number)
+    report('  run_SEIR_wide alone', timeit.timeit(lambda: model.run_SEIR_wide(*DEFAULT_INPUTS), number=number), number)
+    report('  SEIRResult.to_long', timeit.timeit(model.run_SEIR_wide(*DEFAULT_INPUTS).to_long, number=number), number)
+
+@benchmark
+def bench_batch():
+    import os
+    import tempfile
+    import batch
+    rng = np.random.default_rng(0)
+    n = 400
+    first = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 40, n), unit='D')
+    scenarios = pd.DataFrame({'scenario_id': ['s%05i' % i for i in range(n)],
+                              'population': rng.integers(100000, 100000000, n),
+                              'date_of_first_infection': first.strftime('%m-%d-%Y'),
+                              'date_of_lockdown': (first + pd.to_timedelta(rng.integers(20, 90, n), unit='D')).strftime('%m-%d-%Y'),
+                              'intensive_units': 5000, 'mean_days_icu': rng.integers(3, 15, n),
+                              'vents_units_start': 5000, 'vents_units_sh1': 200, 'vents_date_sh1': '03-20-2020'})
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'scenarios.csv')
+        scenarios.to_csv(filename, index=False)
+        for workers in sorted({1, os.cpu_count()}):
+            out_dir = os.path.join(tmp, 'out%i' % workers)
+            summary = batch.run_batch(filename, out_dir, workers=workers)
+            print('%-40s %10.1f scenarios/s' % ('batch, %i scenarios, %i workers' % (n, workers),
+                                                summary['scenarios_per_second']))
+        summary = batch.run_batch(filename, out_dir, workers=workers)
+        print('%-40s %10i skipped' % ('batch rerun (resume)', summary['skipped']))
+
+        # mixed date formats parse the same whatever the chunking, a malformed date fails just its row
+        mixed = scenarios[:12].copy()
+        mixed.loc[::2, 'date_of_lockdown'] = pd.to_datetime(mixed['date_of_lockdown'][::2]).dt.strftime('%Y-%m-%d')
+        mixed.loc[5, 'vents_date_sh1'] = '2020-13-45'
+        mixed.to_csv(filename, index=False)
+        for chunk_size in (1, 5, 50):
+            summary = batch.run_batch(filename, os.path.join(tmp, 'mixed%i' % chunk_size), chunk_size=chunk_size,
+                                      workers=1, report_every=1e9)
+            assert summary['done'] == 11 and summary['failed'] == ['s00005'], summary
+
+def _legacy_cp2(countries, countryPopulation):
+    """population.load's name matching before the alias index: exact name, else any substring"""
+    cp2 = {}
+    for country in countries:
+        if country in countryPopulation:
+            cp2[country] = countryPopulation[country]
+        else:
+            for country2 in countryPopulation:
+                if country in country2:
+                    cp2[country] = countryPopulation[country2]
+    return cp2
+
+
+@benchmark
+def bench_population():
+    import population
+    population.load()
+    names = list(population._countryPopulation)
+    # tracker style names: exact, aliased, and ones the substring scan has to look for
+    queries = (names + list(population.ALIASES) + ['Bahamas, The', 'Gambia, The', 'Congo (Kinshasa)', 'Niger']) * 20
+    number = 5
+    report('substring scan, %i names' % len(queries), timeit.timeit(
+        lambda: _legacy_cp2(queries, population._countryPopulation), number=number), number)
+
+    def indexed():
+        population.load()
+        population.get_populations(queries)
+    report('alias index build + get_populations', timeit.timeit(indexed, number=number), number)
+    report('get_populations, index built', timeit.timeit(lambda: population.get_populations(queries),
+                                                         number=number), number)
+
+    # an unknown exclusion raises like an unknown country instead of giving NaN
+    import contextlib
+    import io
+    assert population.get_population('all', excludeCountries=['China']) < 7.8e9
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            population.get_population('all', excludeCountries=['China', 'Chnia'])
+        raise AssertionError('unknown exclusion accepted')
+    except Exception as e:
+        assert 'Chnia' in str(e), e
+
+    # threads resolving new names while others scan the index for theirs
+    import concurrent.futures
+    population.load()
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(population.lookup, ['Republic of Nowhere %i' % i for i in range(2000)] + queries))
+
+def _legacy_per_capita(top_n=20):
+    """deaths_per_capita.py before per_capita_report: get_country_xcdr per country, again for the top ones"""
+    import population
+    import world_data
+    countries, provinces = world_data.get_countries_provinces()
+    countries = countries + ['Hubei']
+    ranked = []
+    for country in countries:
+        country2, province = ('China', 'Hubei') if country == 'Hubei' else (country, 'all')
+        XCDR_data = np.array(world_data.get_country_xcdr(country2, province=province, returnDates=True))
+        ranked.append((country, XCDR_data[-1, 2] * 1.0e6 / population.get_population(country)))
+    ranked.sort(key=lambda x: -x[1])
+    series = {}
+    for country, _ in ranked[:top_n]:
+        country2, province = ('China', 'Hubei') if country == 'Hubei' else (country, 'all')
+        XCDR_data = np.array(world_data.get_country_xcdr(country2, province=province, returnDates=True))
+        series[country] = (XCDR_data[:, 0], XCDR_data[:, 2] / population.get_population(country) * 1.0e6)
+    return ranked, series
+
+
+@benchmark
+def bench_per_capita():
+    import contextlib
+    import io
+    import deaths_per_capita
+    with contextlib.redirect_stdout(io.StringIO()):
+        ranked, legacy_series = _legacy_per_capita(top_n=5)
+    table, series = deaths_per_capita.per_capita_report(top_n=5, min_population=0, min_deaths=0)
+    assert list(table['region']) == [region for region, _ in ranked]
+    assert np.allclose(table['deaths_per_million'], [value for _, value in ranked], rtol=1e-12)
+    assert list(series.columns) == list(legacy_series)
+    for region, (dates, per_million) in legacy_series.items():
+        observed = series[region].dropna()
+        assert list(observed.index.to_pydatetime()) == list(dates)
+        assert np.allclose(observed.values, per_million.astype(float), rtol=1e-12)
+
+    number = 5
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = timeit.timeit(lambda: _legacy_per_capita(), number=number)
+    report('get_country_xcdr per country', seconds, number)
+    report('per_capita_report', timeit.timeit(lambda: deaths_per_capita.per_capita_report(min_population=0, min_deaths=0),
+                                              number=number), number)
+
+
+
+@benchmark
+def bench_observed():
+    """observed overlay: cached region series vs. a get_country_xcdr scan per callback, LTTB payload size"""
+    import contextlib
+    import io
+    import observed
+    import shared
+    import world_data
+    number = 20
+    regions = [o['value'] for o in observed.region_options()]
+
+    def scan():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for region in regions:
+                country, _, province = region.partition('|')
+                np.array(world_data.get_country_xcdr(country, province or 'all', returnDates=True))
+    for region in regions:
+        observed.region_series(region)
+    report('get_country_xcdr, %i regions' % len(regions), timeit.timeit(scan, number=number), number)
+    report('observed.region_series (cached)', timeit.timeit(lambda: [observed.region_series(r) for r in regions],
+                                                            number=number), number)
+
+    days = 1500  # a few years of daily data
+    x = np.datetime64('2020-01-22') + np.arange(days)
+    y = np.cumsum(np.random.default_rng(0).poisson(50 * (1 + np.sin(np.arange(days) / 60.0)) + 1))
+    keep = observed.lttb(np.arange(days), y, shared.OBSERVED_MAX_POINTS)
+    assert keep[0] == 0 and keep[-1] == days - 1 and np.all(np.diff(keep) > 0)
+    report('lttb %i -> %i points' % (days, len(keep)), timeit.timeit(
+        lambda: observed.lttb(np.arange(days), y, shared.OBSERVED_MAX_POINTS), number=number), number)
+    for name, index in (('full', np.arange(days)), ('lttb', keep)):
+        payload = json.dumps({'x': np.datetime_as_string(x[index]).tolist(), 'y': y[index].tolist()})
+        print('%-40s %10.1f kB' % ('trace json, ' + name, len(payload) / 1000))
+
+    # a reporting gap is filled with the day before, the offset search needs continuous days
+    XCDR_data = observed.region_series(regions[0])
+    gappy = np.delete(XCDR_data, [3, 4, 10], axis=0)
+    filled = observed.fill_days(gappy)
+    assert len(filled) == len(XCDR_data) and np.all(filled[:, 0] == XCDR_data[:, 0])
+    assert np.all(filled[[3, 4], 1:] == gappy[2, 1:]) and np.all(filled[10, 1:] == gappy[7, 1:])
+
+    # the overlay still renders after the job result expired, the model deaths are recomputed
+    from datetime import datetime
+    import plotly
+    import app
+    client = app.server.test_client()
+
+    def overlay(job):
+        response = client.post('/_dash-update-component', json={
+            'output': 'observed-traces.data', 'outputs': {'id': 'observed-traces', 'property': 'data'},
+            'changedPropIds': ['observed-region.value'],
+            'inputs': [{'id': 'observed-region', 'property': 'value', 'value': regions[0]},
+                       {'id': 'trace-hashes', 'property': 'data', 'value': None}],
+            'state': [{'id': 'job', 'property': 'data', 'value': job}]})
+        assert response.status_code == 200, response.status_code
+        return json.loads(response.data)['response']['props']['data']['traces']
+    epidemic = [10000000, '2020-01-15', '2020-03-15']
+    expired = overlay({'key': 'expired', 'epidemic': epidemic})
+    assert len(expired) == 2 and all(len(trace['x']) for trace in expired)
+    assert expired == json.loads(json.dumps(app.observed_traces(regions[0], observed.expected_deaths(
+        app.run_epidemic(10000000, datetime(2020, 1, 15), datetime(2020, 3, 15)).R),
+        np.datetime64('2020-01-15')), cls=plotly.utils.PlotlyJSONEncoder))
+    app.jobs.shutdown()
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('---', name)
+        BENCHMARKS[name]()
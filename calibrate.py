@@ -0,0 +1,232 @@
+"""Fit r0, r1, date of first infection and lockdown (and optionally IFR) of the SEIR model to observed deaths.
+
+Deaths are modelled as IFR * recovered, delayed by the time from the end of infectiousness to
+death (same lags as the unfinished deaths estimate in model.run_SEIR). Candidates are scored on
+the mean squared log error against world_data deaths and searched with the cross entropy method:
+sample a population of candidates, integrate them together with model.solve_batch, keep the best
+ones, resample around them. The search converges when the elite spread has shrunk (or the elite
+mean loss stopped improving) and then restarts around the best candidate a few times to leave
+plateaus. Candidate chunks are evaluated in a process pool, and the search starts from the
+previous fit of a region if there is one in shared.CALIBRATION_FILE.
+
+IFR is fixed (model.infectionFatalityRateA) unless asked for: while only a small share of the
+population is infected the model is linear, an earlier first infection multiplies all deaths by
+the growth over the extra days, so deaths only determine IFR * exp(growth * days), not both.
+
+usage: python calibrate.py [--lockdown MM-DD-YYYY] [--ifr IFR | --fit-ifr] [--workers N] country [country ...]
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+import model
+import population
+import shared
+import world_data
+
+# days from leaving the infectious compartment to a reported death
+death_lag = round(-model.days_infectious + model.days_presymptomatic + model.symptom_to_hospital_lag
+                  + model.days_in_hospital + model.communication_lag)
+
+# candidate vector: r0, r1, days from first infection to first data, log10(IFR), days from first data to
+# lockdown (not from first infection, which would tie it to the third entry)
+BOUNDS = np.array([[1.2, 6.0],
+                   [0.2, 2.5],
+                   [0.0, 120.0],
+                   [-3.5, -1.0],
+                   [-60.0, 120.0]])
+
+
+def observed_deaths(country, province='all'):
+    """dates (datetime64[D]) and cumulative deaths of a region"""
+    with contextlib.redirect_stdout(io.StringIO()):  # get_country_xcdr is chatty
+        XCDR_data = world_data.get_country_xcdr(country, province, returnDates=True)
+    dates = np.array([x[0] for x in XCDR_data], dtype='M8[D]')
+    deaths = np.array([x[2] for x in XCDR_data], dtype=float)
+    return dates, deaths
+
+
+def _evaluate(args):
+    """losses of a chunk of candidates; top level so a process pool can run it"""
+    candidates, N, deaths = args
+    r0, r1, days_to_data, log_ifr, lockdown_after_data = candidates.T
+    days_to_data = np.round(days_to_data).astype(int)
+    days0 = days_to_data + np.round(lockdown_after_data)
+    days_total = days_to_data.max() + len(deaths)
+    SEIR = model.solve_batch(N, model.E0, r0 * model.gamma, days0, r1 * model.gamma,
+                             model.gamma, model.sigma, days_total)
+    R = SEIR[:, 3]
+    index = days_to_data[:, None] + np.arange(len(deaths)) - death_lag
+    D_model = 10 ** log_ifr[:, None] * np.where(index >= 0, R[np.arange(len(R))[:, None], np.clip(index, 0, None)], 0.0)
+    return np.mean(np.square(np.log1p(deaths) - np.log1p(D_model)), axis=1)
+
+
+def _load_fits(filename=None):
+    try:
+        with open(filename or shared.CALIBRATION_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_fits(fits, filename=None):
+    filename = filename or shared.CALIBRATION_FILE
+    tmp = filename + '.tmp%i' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(fits, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def _region_key(country, province):
+    return country if province == 'all' else '%s/%s' % (country, province)
+
+
+def fit(deaths, N, ifr=model.infectionFatalityRateA, lockdown_after_data=None, start=None,
+        samples=256, elite=0.1, smoothing=0.7, max_iterations=300, spread=1e-3, patience=10, tol=1e-4, restarts=3,
+        workers=None, seed=0):
+    """Cross entropy search for the candidate vector (see BOUNDS) that fits the cumulative deaths per day.
+
+    ifr: fixed IFR, None fits it as well (see the module docstring)
+    lockdown_after_data: days from the first data day to the lockdown, fitted when None
+    start: candidate vector to search around (warm start), else the middle of BOUNDS
+    samples: candidates per iteration, the best elite fraction of them moves the sampling distribution,
+    by smoothing (1: all the way) per iteration
+    spread, patience, tol: converged when the elite standard deviation is below spread times the bounds
+    of every fitted entry, or after patience iterations that improved the elite mean loss by less than tol
+    (relative); then the search restarts around the best candidate, restarts times
+    Returns (best candidate, its loss, iterations, evaluations).
+    """
+    rng = np.random.default_rng(seed)
+    lo, hi = BOUNDS.T.copy()
+    if ifr is not None:
+        lo[3] = hi[3] = np.log10(ifr)
+    if lockdown_after_data is not None:
+        lo[4] = hi[4] = lockdown_after_data
+    fitted = hi > lo
+    if start is not None:
+        mean, std = np.clip(start, lo, hi), (hi - lo) / 20
+    else:
+        mean, std = (lo + hi) / 2, (hi - lo) / 4
+    n_elite = max(2, int(elite * samples))
+
+    executor = concurrent.futures.ProcessPoolExecutor(workers) if workers else None
+    best, best_loss, evaluations = None, np.inf, 0
+    elite_loss, stale, restart = np.inf, 0, 0
+    try:
+        for iteration in range(max_iterations):
+            candidates = np.clip(rng.normal(mean, std, (samples, len(mean))), lo, hi)
+            if executor is not None:
+                chunks = np.array_split(candidates, workers)
+                losses = np.concatenate(list(executor.map(_evaluate, [(chunk, N, deaths) for chunk in chunks])))
+            else:
+                losses = _evaluate((candidates, N, deaths))
+            evaluations += len(candidates)
+
+            order = np.argsort(losses)
+            elites = candidates[order[:n_elite]]
+            mean = smoothing * elites.mean(axis=0) + (1 - smoothing) * mean
+            std = smoothing * elites.std(axis=0) + (1 - smoothing) * std
+            if losses[order[0]] < best_loss:
+                best, best_loss = candidates[order[0]], losses[order[0]]
+
+            loss = losses[order[:n_elite]].mean()
+            stale = 0 if loss < elite_loss * (1 - tol) else stale + 1
+            elite_loss = min(elite_loss, loss)
+            if np.all(std[fitted] <= spread * (hi - lo)[fitted]) or stale >= patience:
+                if restart == restarts:
+                    break
+                restart += 1
+                mean, std, elite_loss, stale = best.copy(), (hi - lo) / 10, np.inf, 0
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return best, best_loss, iteration + 1, evaluations
+
+
+def calibrate(country, province='all', date_of_lockdown=None, warm_start=None, ifr=model.infectionFatalityRateA,
+              workers=None, seed=0):
+    """Fit one region, returns a dict with r0, r1, date_of_first_infection, ifr, date_of_lockdown and loss.
+
+    date_of_lockdown: datetime, fitted as well when None
+    warm_start: previous result dict of this region, the search starts around it
+    ifr: fixed IFR, None fits it as well (see the module docstring)
+    workers: size of the process pool for candidate evaluation, None evaluates in this process
+    """
+    dates, deaths = observed_deaths(country, province)
+    if deaths.max() < 10:
+        raise ValueError("calibrate: too few deaths in %s to calibrate" % _region_key(country, province))
+    N = population.get_population(country, province)
+
+    lockdown_after_data = None
+    if date_of_lockdown is not None:
+        lockdown_after_data = (np.datetime64(date_of_lockdown, 'D') - dates[0]).astype(int)
+    start = None
+    if warm_start:
+        days_to_data = (dates[0] - np.datetime64(warm_start['date_of_first_infection'], 'D')).astype(int)
+        start = [warm_start['r0'], warm_start['r1'], days_to_data, np.log10(ifr or warm_start['ifr']),
+                 (np.datetime64(warm_start['date_of_lockdown'], 'D') - dates[0]).astype(int)]
+
+    best, loss, iterations, evaluations = fit(deaths, N, ifr, lockdown_after_data, start, workers=workers, seed=seed)
+    r0, r1, days_to_data, log_ifr, lockdown_after_data = best
+    date_of_first_infection = dates[0] - np.timedelta64(int(round(days_to_data)), 'D')
+    return {'region': _region_key(country, province),
+            'r0': float(r0), 'r1': float(r1), 'ifr': float(10 ** log_ifr),
+            'date_of_first_infection': str(date_of_first_infection),
+            'date_of_lockdown': str(dates[0] + np.timedelta64(int(round(lockdown_after_data)), 'D')),
+            'loss': float(loss), 'iterations': iterations, 'evaluations': evaluations}
+
+
+def _calibrate_region(args):
+    country, province, date_of_lockdown, warm_start, ifr = args
+    try:
+        return calibrate(country, province, date_of_lockdown, warm_start, ifr)
+    except Exception as e:
+        print("fail: ", _region_key(country, province), e)
+        return None
+
+
+def calibrate_all(regions, lockdowns=None, workers=None, filename=None, ifr=model.infectionFatalityRateA):
+    """Fit many regions in a process pool, one region per task, warm started from and saved to filename.
+
+    regions: list of (country, province); lockdowns: optional {region key: datetime}; ifr: see calibrate
+    """
+    lockdowns = lockdowns or {}
+    fits = _load_fits(filename)
+    tasks = [(country, province, lockdowns.get(_region_key(country, province)), fits.get(_region_key(country, province)),
+              ifr) for country, province in regions]
+    world_data.get_data()  # load once before forking
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for result in executor.map(_calibrate_region, tasks):
+            if result is not None:
+                fits[result['region']] = result
+    _save_fits(fits, filename)
+    return fits
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fit r0, r1, date of first infection and lockdown to observed deaths')
+    parser.add_argument('countries', nargs='+', help="country names, 'Country/Province' for a province")
+    parser.add_argument('--lockdown', help='date of lockdown MM-DD-YYYY (all regions), fitted if not given')
+    parser.add_argument('--ifr', type=float, default=model.infectionFatalityRateA, help='infection fatality rate')
+    parser.add_argument('--fit-ifr', action='store_true', help='fit the IFR too (only identifiable in large outbreaks)')
+    parser.add_argument('--workers', type=int, default=None, help='processes, default: all cores')
+    args = parser.parse_args()
+
+    regions = [tuple(c.split('/', 1)) if '/' in c else (c, 'all') for c in args.countries]
+    lockdowns = {}
+    if args.lockdown:
+        date_of_lockdown = datetime.strptime(args.lockdown, '%m-%d-%Y')
+        lockdowns = {_region_key(*region): date_of_lockdown for region in regions}
+    fits = calibrate_all(regions, lockdowns, args.workers, ifr=None if args.fit_ifr else args.ifr)
+    for country, province in regions:
+        result = fits.get(_region_key(country, province))
+        if result:
+            print("%-20s r0: %.2f  r1: %.2f  first infection: %s  lockdown: %s  IFR: %.4f  loss: %.4f"
+                  % (result['region'], result['r0'], result['r1'], result['date_of_first_infection'],
+                     result['date_of_lockdown'], result['ifr'], result['loss']))
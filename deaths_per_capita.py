@@ -1,81 +1,95 @@
-import sys
+"""Countries (and a few provinces) ranked by deaths - or cases, recovered - per 1M capita.
+
+usage: python deaths_per_capita.py [--metric deaths] [--top 20] [--min-population 1e6] [--min-deaths 10]
+                                   [--output plot.png]
+"""
+import argparse
+
 import numpy as np
-import matplotlib.pyplot as plt
+import pandas as pd
 
 import population
 import world_data
 
-countries, provinces = world_data.get_countries_provinces()
-countryPopulation = population.get_all_population_data()
-countries.extend(['Hubei'])
-
-# todo: single loop, cleanup
-
-countryDeaths = []
-for country in countries:
-    try:
-        if countryPopulation[country] < 1000000:
-            continue
-        province = 'all'
-        country2 = country
-        if country == 'Hubei':
-            country2 = 'China'
-            province = 'Hubei'
-        XCDR_data = np.array(world_data.get_country_xcdr(country2, province=province,
-                                                         returnDates=True))
-        cases = int(XCDR_data[-1, 1])  # last row, third column
-        deaths = int(XCDR_data[-1, 2])  # last row, third column
-        if deaths < 10:
-            continue
-        recovered = int(XCDR_data[-1, 3])  # last row, third column
-        date = XCDR_data[-1, 0]
-        countryDeaths.append((country, cases, deaths, recovered, date))
-
-    except Exception as e:
-        print("fail: ", country, sys.exc_info()[0], e)
-
-countryDeathsPC = []
-for ccdrd in countryDeaths:
-    country, cases, deaths, recovered, date = ccdrd
-    try:
-        pop = population.get_population(country)
-        countryDeathsPC.append((country, deaths * 1.0e6 / pop, deaths, pop, date))
-        #countryDeathrate.append((country, 100.0 * deaths / cases, deaths, pop))
-    except KeyError:
-        print("fail: ", country)
-
-print()
-countryDeathsPC = sorted(countryDeathsPC, key = lambda x: x[1])  # sort by second subitem
-countryDeathsPC.reverse()  # in place
-
-
-dCountryDeathsPCXY = {}
-for country, trash, trash, trash, trash in countryDeathsPC[0:20]:
-    province = 'all'
-    country2 = country
-    if country == 'Hubei':
-        country2 = 'China'
-        province = 'Hubei'
-    XCDR_data = np.array(world_data.get_country_xcdr(country2, province=province, returnDates=True))
-    pop = population.get_population(country)
-    #Y = 100.0 * XCDR_data[:,2] / XCDR_data[:,1] 
-    Y = XCDR_data[:,2] / pop * 1.0e6
-    dCountryDeathsPCXY[country] = (XCDR_data[:,0], Y)
-
-
-fig = plt.figure(dpi=75, figsize=(20,16))
-ax = fig.add_subplot(111)
-#ax.set_yscale("log", nonposy='clip')
-
-for country in dCountryDeathsPCXY:
-    ax.plot(dCountryDeathsPCXY[country][0], dCountryDeathsPCXY[country][1],
-            alpha=0.5, lw=2, label=country)
-
-legend = ax.legend(title='deaths per 1M capita (beta)')
-
-print()
-print('beta, there might be bugs')
-for country, deathsPC, deaths, pop, date in countryDeathsPC[0:20]:
-    print("%-15s" % country, ': %10.1f %5d %10d %s' % (deathsPC, deaths, pop, date.strftime("%Y-%m-%d")))
-
-plt.show()
+METRICS = ('confirmed', 'deaths', 'recovered')
+
+
+def per_capita_report(metric='deaths', top_n=20, min_population=1000000, min_deaths=10, provinces=('Hubei',)):
+    """Rank every country and the given provinces by metric per 1M capita.
+
+    Countries come from the WorldData's country_totals(), provinces are summed over their rows. Regions below
+    min_population, with fewer than min_deaths deaths or without a known population are left out.
+    Returns (table, series): table has one row per ranked region with population, latest confirmed,
+    deaths, recovered and <metric>_per_million, best first; series holds the per 1M capita time
+    series of the top_n regions, one column each, NaN before a region's first data.
+    """
+    if metric not in METRICS:
+        raise ValueError("per_capita_report: unknown metric '%s', expected one of %s" % (metric, METRICS))
+    data = world_data.get_data()
+
+    # region x day totals: every country, then the extra provinces
+    countries, country_totals = data.country_totals()
+    names, totals = list(countries), [country_totals]
+    for province in provinces:
+        locations = data.rows(province=province)
+        if len(locations):
+            names.append(province)
+            totals.append(np.stack(data.aggregate(locations))[:, np.newaxis])
+    totals = dict(zip(METRICS, np.concatenate(totals, axis=1).astype(float)))
+    pop = population.get_populations(names)
+    latest = {m: totals[m][:, -1] for m in METRICS}
+    with np.errstate(invalid='ignore'):
+        keep = (pop >= min_population) & (latest['deaths'] >= min_deaths)
+    per_million = totals[metric] * 1.0e6 / pop[:, None]
+
+    column = metric + '_per_million'
+    table = pd.DataFrame({'region': names, 'population': pop,
+                          'confirmed': latest['confirmed'].astype(np.int64), 'deaths': latest['deaths'].astype(np.int64),
+                          'recovered': latest['recovered'].astype(np.int64), column: per_million[:, -1]})[keep]
+    table = table.sort_values(column, ascending=False, kind='stable')
+    table['date'] = pd.Timestamp(data.dates[-1])
+
+    top = table.index[:top_n]
+    has_data = sum(totals.values())[top] > 0
+    series = pd.DataFrame(np.where(has_data, per_million[top], np.nan).T, index=pd.DatetimeIndex(data.dates),
+                          columns=table['region'][:top_n])
+    return table.reset_index(drop=True), series
+
+
+def plot_report(table, series, metric='deaths', filename=None):
+    """plot the series, to filename if given (works without a display), else in a window"""
+    import matplotlib
+    if filename:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(dpi=75, figsize=(20, 16))
+    ax = fig.add_subplot(111)
+    for region in series:
+        ax.plot(series.index, series[region], alpha=0.5, lw=2, label=region)
+    ax.legend(title='%s per 1M capita (beta)' % metric)
+    if filename:
+        fig.savefig(filename)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rank regions by deaths (or cases, recovered) per 1M capita')
+    parser.add_argument('--metric', choices=METRICS, default='deaths')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--min-population', type=float, default=1000000)
+    parser.add_argument('--min-deaths', type=int, default=10)
+    parser.add_argument('--output', help='write the plot to this file instead of showing it')
+    args = parser.parse_args()
+
+    table, series = per_capita_report(args.metric, args.top, args.min_population, args.min_deaths)
+
+    print()
+    print('beta, there might be bugs')
+    for row in table[:args.top].itertuples(index=False):
+        print("%-15s" % row.region, ': %10.1f %5d %10d %s' % (getattr(row, args.metric + '_per_million'),
+                                                              getattr(row, args.metric), row.population,
+                                                              row.date.strftime("%Y-%m-%d")))
+    plot_report(table, series, args.metric, args.output)
@@ -0,0 +1,154 @@
+"""Monte Carlo uncertainty bands for ICU and ventilator demand.
+
+The literature values icu_rate, vent_rate, percent_asymptomatic and generation_time of model.py are
+sampled from DISTRIBUTIONS, every batch of samples is integrated at once with model.solve_batch and
+run through model.demand. Batches are computed in a process pool and written into shared memory
+slots; the parent folds every finished batch into per day histograms, so memory stays constant no
+matter how many samples are drawn, and reads P5 / P50 / P95 and the probability that demand
+exceeds the ventilator supply from them.
+"""
+import concurrent.futures
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import model
+
+# parameter: (numpy.random.Generator method, arguments)
+DISTRIBUTIONS = {
+    'icu_rate': ('triangular', (0.04, model.icu_rate, 0.12)),
+    'vent_rate': ('triangular', (0.25, model.vent_rate, 0.6)),
+    'percent_asymptomatic': ('uniform', (0.2, 0.5)),
+    'generation_time': ('triangular', (3.9, model.generation_time, 5.5)),
+}
+
+PERCENTILES = (5, 50, 95)
+SERIES = ('needs_icu', 'needs_ventilator')
+
+# histogram bins: one for 0, then log spaced, about 1.4% wide, up to 2e9 patients
+BIN_EDGES = np.concatenate(([0.0], np.geomspace(0.5, 2e9, 1500)))
+
+
+def sample_parameters(n, rng, distributions=None):
+    """dict of n samples per parameter of DISTRIBUTIONS. Given distributions, only its parameters are sampled,
+    the others keep their model.py value"""
+    if distributions is None:
+        distributions = DISTRIBUTIONS
+    parameters = {name: np.full(n, float(getattr(model, name))) for name in DISTRIBUTIONS}
+    parameters.update((name, getattr(rng, method)(*args, size=n)) for name, (method, args) in distributions.items())
+    return parameters
+
+
+def simulate(parameters, population, days_before_lockdown, mean_days_icu, r0=model.r0, r1=model.r1):
+    """needs_icu and needs_ventilator, (samples x days) each, for sampled parameters.
+
+    ICU demand applies to symptomatic cases: icu_rate is rescaled by the symptomatic share relative
+    to model.percent_asymptomatic, so the model.py defaults reproduce run_SEIR.
+    """
+    generation_time = np.maximum(parameters['generation_time'], 1.0 / model.sigma + 0.1)
+    gamma = 1.0 / (2.0 * (generation_time - 1.0 / model.sigma))
+    SEIR = model.solve_batch(population, model.E0, r0 * gamma, days_before_lockdown, r1 * gamma, gamma,
+                             model.sigma, model.days_total)
+    icu_rate = parameters['icu_rate'] * (1 - parameters['percent_asymptomatic']) / (1 - model.percent_asymptomatic)
+    demand = model.demand(SEIR[:, 2], mean_days_icu, icu_rate[:, None], parameters['vent_rate'][:, None])
+    return np.nan_to_num(demand.needs_icu), np.nan_to_num(demand.needs_ventilator)
+
+
+def _run_batch(args):
+    """compute one batch in a worker and write it to its slot of the shared result block"""
+    shm_name, shape, slot, seed, n, distributions, simulate_args = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        results = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        parameters = sample_parameters(n, np.random.default_rng(seed), distributions)
+        results[slot, 0, :n], results[slot, 1, :n] = simulate(parameters, *simulate_args)
+        del results  # release the buffer before closing
+    finally:
+        shm.close()
+    return slot, n
+
+
+class _Histograms:
+    """streaming per day histograms of several series"""
+
+    def __init__(self, n_series, days):
+        self.counts = np.zeros((n_series, days, len(BIN_EDGES)), dtype=np.int64)
+        self.n = 0
+
+    def add(self, values):
+        """values: (n_series, samples, days)"""
+        n_series, samples, days = values.shape
+        bins = np.searchsorted(BIN_EDGES, values, side='right') - 1
+        flat = (np.arange(n_series)[:, None, None] * days + np.arange(days)) * len(BIN_EDGES) + bins
+        self.counts += np.bincount(flat.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+        self.n += samples
+
+    def percentile(self, q):
+        """(n_series, days), upper edge of the bin holding the q-th percentile, 0 for the zero bin"""
+        cumulative = np.cumsum(self.counts, axis=-1)
+        index = np.argmax(cumulative >= q / 100.0 * self.n, axis=-1)
+        upper = np.append(BIN_EDGES[1:], np.inf)
+        return np.where(index == 0, 0.0, upper[index])
+
+
+def run_ensemble(population, date_of_first_infection, date_of_lockdown, mean_days_icu, vents_schedule,
+                 n=1000, batch_size=250, workers=None, distributions=None, seed=0):
+    """Percentile bands of needs_icu and needs_ventilator over n sampled parameter sets.
+
+    vents_schedule: supply.SupplySchedule to compare ventilator demand with
+    workers: size of the process pool, None or 0 computes all batches in this process
+    distributions: the parameters to sample, default DISTRIBUTIONS; the others keep their model.py value
+
+    Returns a DataFrame indexed by date with columns needs_icu_p5 ... needs_ventilator_p95, vents and
+    p_exceed, the share of samples whose ventilator demand exceeds vents on that day.
+    """
+    days_before_lockdown = (date_of_lockdown - date_of_first_infection).days
+    dates = pd.Timestamp(date_of_first_infection) + pd.to_timedelta(np.arange(model.days_total), unit='D')
+    vents = vents_schedule.units(dates)
+    simulate_args = (population, days_before_lockdown, mean_days_icu)
+    batches = [min(batch_size, n - start) for start in range(0, n, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+
+    histograms = _Histograms(len(SERIES), model.days_total)
+    exceed = np.zeros(model.days_total, dtype=np.int64)
+
+    def fold(needs_icu, needs_ventilator):
+        histograms.add(np.stack((needs_icu, needs_ventilator)))
+        exceed[:] += (needs_ventilator > vents).sum(axis=0)
+
+    if not workers:
+        for seed, size in zip(seeds, batches):
+            fold(*simulate(sample_parameters(size, np.random.default_rng(seed), distributions), *simulate_args))
+    else:
+        slots = 2 * workers  # batches in flight, bounds the shared memory
+        shape = (slots, len(SERIES), batch_size, model.days_total)
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+        try:
+            results = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                pending = {}
+                todo = list(zip(seeds, batches))
+                free = list(range(slots))
+                while todo or pending:
+                    while todo and free:
+                        seed, size = todo.pop(0)
+                        args = (shm.name, shape, free.pop(), seed, size, distributions, simulate_args)
+                        future = executor.submit(_run_batch, args)
+                        pending[future] = args
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        del pending[future]
+                        slot, size = future.result()
+                        fold(results[slot, 0, :size], results[slot, 1, :size])
+                        free.append(slot)
+            del results
+        finally:
+            shm.close()
+            shm.unlink()
+
+    bands = {'vents': vents, 'p_exceed': exceed / n}
+    for q in PERCENTILES:
+        for name, values in zip(SERIES, histograms.percentile(q)):
+            bands['%s_p%i' % (name, q)] = values
+    return pd.DataFrame(bands, index=dates)
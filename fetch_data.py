@@ -1,19 +1,130 @@
+import contextlib
+import gzip
+import http.client
+import json
+import os
+import shutil
+import time
+import urllib.error
 import urllib.request
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # windows, no locking between workers
+    fcntl = None
 
 import shared
 
-def fetch():
-    url = urllib.request.urlopen(urllib.request.Request(shared.APIURL, headers={
-        'User-Agent' : 'https://github.com/coronafighter/coronaSEIR'}))
-    r = url.read()
-    
-    print("read bytes from %s: %i" % (shared.APIURL, len(r)))
-    
-    if len(r) < 1000:
-        raise Exception("fetch_data.py read less than 1000 bytes")
-    
-    with open(shared.FILENAME, 'wb') as f:
-        f.write(r)
-    
+
+class FetchError(OSError):
+    """a download that broke off or is not a plausible payload, the file on disk is left as it was"""
+
+
+def _meta_path(filename):
+    return filename + '.http.json'  # ETag / Last-Modified of the download and when it was last checked
+
+
+def _read_meta(filename):
+    try:
+        with open(_meta_path(filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(filename, meta):
+    tmp = _meta_path(filename) + '.tmp%i' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, _meta_path(filename))
+
+
+@contextlib.contextmanager
+def _lock(filename):
+    """exclusive lock so only one of several workers downloads at a time"""
+    with open(filename + '.lock', 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def last_checked(filename=shared.FILENAME):
+    """time of the last download or of the last 'not modified' answer, 0 if there is no file"""
+    if not os.path.exists(filename):
+        return 0
+    return max(os.path.getmtime(filename), _read_meta(filename).get('checked', 0))
+
+
+def is_stale(filename=shared.FILENAME, max_age=shared.CACHETIMESECONDS):
+    return last_checked(filename) < time.time() - max_age
+
+
+def fetch(url=shared.APIURL, filename=shared.FILENAME, max_age=None, timeout=shared.FETCH_TIMEOUT):
+    """Download url to filename, returns True if the file changed.
+
+    Sends If-None-Match / If-Modified-Since from the previous download, so an unchanged payload costs
+    one 304 round trip, and asks for gzip. The body is streamed into a temp file that is renamed over
+    filename, so readers never see a half written file. With max_age, a file that another worker
+    refreshed while we waited for the lock is not downloaded again. timeout: seconds to wait for the
+    server to connect or send more data, a hung server raises instead of holding the lock. A download
+    that broke off or is too short raises FetchError, an OSError like network errors and timeouts.
+    """
+    with _lock(filename):
+        if max_age is not None and not is_stale(filename, max_age):
+            return False
+
+        meta = _read_meta(filename) if os.path.exists(filename) else {}
+        headers = {'User-Agent': 'https://github.com/coronafighter/coronaSEIR',
+                   'Accept-Encoding': 'gzip'}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            print("%s not modified" % url)
+            meta['checked'] = time.time()
+            _write_meta(filename, meta)
+            return False
+
+        with response:
+            stream = response
+            if response.headers.get('Content-Encoding') == 'gzip':
+                stream = gzip.GzipFile(fileobj=response)
+            tmp = filename + '.tmp%i' % os.getpid()
+            try:
+                with open(tmp, 'wb') as f:
+                    try:
+                        shutil.copyfileobj(stream, f, 1 << 20)
+                    except (EOFError, zlib.error, http.client.HTTPException) as e:  # truncated or corrupt body
+                        raise FetchError("incomplete download from %s: %r" % (url, e)) from e
+                    if response.length:  # read(amt) returns what arrived when the connection closes early
+                        raise FetchError("incomplete download from %s: %i bytes missing" % (url, response.length))
+                    size = f.tell()
+
+                print("read bytes from %s: %i" % (url, size))
+
+                if size < 1000:
+                    raise FetchError("fetch_data.py read less than 1000 bytes")
+
+                os.replace(tmp, filename)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+        _write_meta(filename, {'etag': response.headers.get('ETag'),
+                               'last_modified': response.headers.get('Last-Modified'),
+                               'checked': time.time()})
+        return True
+
 if __name__ == '__main__':
     fetch()
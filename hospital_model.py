@@ -0,0 +1,153 @@
+"""SEIR model with explicit hospital, ICU and ventilator compartments and optional age groups.
+
+Instead of deriving ICU and ventilator demand from the infectious curve after the fact (model.run_demand),
+patients flow through the compartments
+
+    S -> E -> I -> R
+              I -> H (ward) -> R / D
+              I -> P (hospital, later ICU) -> C (ICU) -> R / D
+                                                C -> V (ventilated) -> R / D
+
+per age group. All flows except new infections are linear and within a group, they are assembled once
+into a sparse matrix; infections use the (dense, groups x groups) contact matrix. ICU patients beyond
+intensive_units and ventilated patients beyond the ventilators available that day die with the higher
+probabilities p_death_no_icu / p_death_no_ventilator - the ICU saturation the unfinished deaths block in
+model.run_SEIR was after.
+"""
+import collections
+
+import numpy as np
+import pandas as pd
+import scipy.integrate
+import scipy.sparse
+
+import model
+
+COMPARTMENTS = ('S', 'E', 'I', 'H', 'P', 'C', 'V', 'R', 'D')
+S, E, I, H, P, C, V, R, D = range(len(COMPARTMENTS))
+
+# --- parameters, defaults from model.py where it has them ---
+p_hospital = 0.05  # share of infections that need a hospital - assumption, scaled per age group by AgeGroups
+p_icu = model.icu_rate  # share of hospitalized that need an ICU
+p_ventilator = model.vent_rate  # share of ICU patients that need a ventilator
+days_in_hospital = model.days_in_hospital
+hospital_to_icu_lag = model.hospital_to_icu_lag
+p_death_ventilator = 0.5  # ventilated patients who die although ventilated - assumption
+p_death_icu = 0.2  # ICU patients without ventilation who die although in an ICU - assumption
+# ward deaths so that the infection fatality rate is model.infectionFatalityRateA while capacity lasts
+p_death_hospital = ((model.infectionFatalityRateA / p_hospital
+                     - p_icu * ((1 - p_ventilator) * p_death_icu + p_ventilator * p_death_ventilator))
+                    / (1 - p_icu))
+p_death_no_icu = 0.9  # ICU patients beyond intensive_units - assumption
+p_death_no_ventilator = 0.95  # ventilated patients beyond the available ventilators - assumption
+
+# shares: population share per group, contacts: mean daily contacts of group i with group j (only
+# relative values matter, r0 fixes the scale), hospital_rate: p_hospital multiplier per group
+AgeGroups = collections.namedtuple('AgeGroups', ['names', 'shares', 'contacts', 'hospital_rate'])
+SINGLE_GROUP = AgeGroups(('all',), np.ones(1), np.ones((1, 1)), np.ones(1))
+
+
+def transition_matrix(groups, mean_days_icu, days_on_ventilator):
+    """sparse (compartments * groups) square matrix of all linear flows, state index = compartment * G + group"""
+    G = len(groups.shares)
+    p_h = np.clip(p_hospital * np.asarray(groups.hospital_rate, dtype=float), 0, 1)
+    icu_out = 1.0 / mean_days_icu
+    flows = [  # from, to, rate per group
+        (E, I, model.sigma),
+        (I, R, model.gamma * (1 - p_h)),
+        (I, H, model.gamma * p_h * (1 - p_icu)),
+        (I, P, model.gamma * p_h * p_icu),
+        (H, R, (1 - p_death_hospital) / days_in_hospital),
+        (H, D, p_death_hospital / days_in_hospital),
+        (P, C, 1.0 / hospital_to_icu_lag),
+        (C, V, p_ventilator * icu_out),
+        (C, R, (1 - p_ventilator) * (1 - p_death_icu) * icu_out),
+        (C, D, (1 - p_ventilator) * p_death_icu * icu_out),
+        (V, R, (1 - p_death_ventilator) / days_on_ventilator),
+        (V, D, p_death_ventilator / days_on_ventilator),
+    ]
+    rows, cols, values = [], [], []
+    group = np.arange(G)
+    for source, target, rate in flows:
+        rate = np.broadcast_to(rate, (G,))
+        rows += [target * G + group, source * G + group]
+        cols += [source * G + group, source * G + group]
+        values += [rate, -rate]
+    size = len(COMPARTMENTS) * G
+    return scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(size, size))
+
+
+def rhs(Y, t, A, N, contacts, beta0, days0, beta1, intensive_units, vents, mean_days_icu, days_on_ventilator):
+    """derivative of the flattened state; vents: ventilators available per day"""
+    G = len(N)
+    X = Y.reshape(len(COMPARTMENTS), G)
+    dY = A @ Y
+    dX = dY.reshape(len(COMPARTMENTS), G)  # view
+
+    beta = beta0 if t < days0 else beta1
+    infections = beta * X[S] * (contacts @ (X[I] / N))
+    dX[S] -= infections
+    dX[E] += infections
+
+    # capacity: share of ICU patients without an ICU bed, share of ventilated patients without a ventilator
+    icu_load = X[C].sum() + X[V].sum()
+    no_icu = max(0.0, 1.0 - intensive_units / icu_load) if icu_load > 0 else 0.0
+    ventilated = X[V].sum()
+    available = vents[min(int(t), len(vents) - 1)]
+    no_ventilator = 1.0 - (1.0 - no_icu) * (min(1.0, available / ventilated) if ventilated > 0 else 1.0)
+    extra = (no_icu * (p_death_no_icu - p_death_icu) * (1 - p_ventilator) / mean_days_icu * X[C]
+             + no_ventilator * (p_death_no_ventilator - p_death_ventilator) / days_on_ventilator * X[V])
+    dX[R] -= extra
+    dX[D] += extra
+    return dY
+
+
+def solve(population, E0, r0, r1, days0, days_total, intensive_units, vents, mean_days_icu,
+          days_on_ventilator=None, groups=SINGLE_GROUP):
+    """Integrate the model, returns an array (compartments, groups, days).
+
+    r0 / r1: basic reproduction number before / after the lockdown on day days0; beta is scaled by the
+    spectral radius of the next generation matrix, so with a single group this is the SEIR of model.py
+    vents: scalar or ventilators available per day
+    E0 exposed people are spread over the groups by population share.
+    """
+    days_on_ventilator = days_on_ventilator or mean_days_icu
+    shares = np.asarray(groups.shares, dtype=float) / np.sum(groups.shares)
+    N = population * shares
+    contacts = np.asarray(groups.contacts, dtype=float)
+    # next generation matrix K[i, j] = beta / gamma * contacts[i, j] * N[i] / N[j]
+    radius = np.abs(np.linalg.eigvals(contacts * N[:, None] / N[None, :])).max()
+    beta0, beta1 = (r * model.gamma / radius for r in (r0, r1))
+    vents = np.broadcast_to(np.asarray(vents, dtype=float), (days_total,))
+
+    G = len(N)
+    Y0 = np.zeros((len(COMPARTMENTS), G))
+    Y0[E] = E0 * shares
+    Y0[S] = N - Y0[E]
+    A = transition_matrix(groups, mean_days_icu, days_on_ventilator)
+    Y = scipy.integrate.odeint(rhs, Y0.ravel(), np.arange(days_total),
+                               args=(A, N, contacts, beta0, days0, beta1, intensive_units, vents,
+                                     mean_days_icu, days_on_ventilator))
+    return Y.reshape(days_total, len(COMPARTMENTS), G).transpose(1, 2, 0)
+
+
+def run(population, date_of_first_infection, date_of_lockdown, intensive_units, mean_days_icu, vents_schedule,
+        r0=model.r0, r1=model.r1, groups=SINGLE_GROUP, days_total=model.days_total):
+    """DataFrame per day: infectious, hospital, needs_icu (C + V), needs_ventilator (V), vents, deaths.
+
+    vents_schedule: supply.SupplySchedule of the ventilators available
+    """
+    dates = pd.Timestamp(date_of_first_infection) + pd.to_timedelta(np.arange(days_total), unit='D')
+    vents = vents_schedule.units(dates)
+    days0 = (date_of_lockdown - date_of_first_infection).days
+    Y = solve(population, model.E0, r0, r1, days0, days_total, intensive_units, vents, mean_days_icu,
+              groups=groups).sum(axis=1)
+    return pd.DataFrame({'date': dates,
+                         'infectious': Y[I],
+                         'hospital': Y[H] + Y[P],
+                         'needs_icu': Y[C] + Y[V],
+                         'needs_ventilator': Y[V],
+                         'vents': vents,
+                         'deaths': Y[D],
+                         })
@@ -0,0 +1,118 @@
+"""Background jobs for the Dash server: model runs go to a worker pool instead of the request thread.
+
+A job is keyed by a hash of its function and arguments, so identical requests that arrive while one
+is queued or running merge into the same job, and finished results are kept for a while so repeating
+a request is served from memory (failures are reported, but a repeated request runs again). Callers
+submit, get the key back at once and poll status() (or block in wait() for long polling). When a pool
+process dies (OOM kill, crash) the pool is replaced on the next submit.
+"""
+import concurrent.futures
+import concurrent.futures.process
+import hashlib
+import pickle
+import threading
+import time
+
+import cache
+
+
+def job_key(func, args):
+    """hash of the function and its (picklable) arguments"""
+    return hashlib.sha1(pickle.dumps((func.__module__, func.__qualname__, args))).hexdigest()
+
+
+class JobQueue:
+    """Worker pool with deduplicated jobs.
+
+    workers: processes in the pool, executor: use this concurrent.futures executor instead
+    keep, ttl: number of finished results kept and seconds they stay valid
+    """
+
+    def __init__(self, workers=None, executor=None, keep=256, ttl=600):
+        self._executor = executor
+        self._workers = workers
+        self._jobs = {}  # key -> [future, time submitted, sequence number]
+        self._results = cache.LRUCache(keep, ttl)  # key -> ('done', result, seconds) / ('failed', error, seconds)
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self.submitted = 0
+        self.merged = 0
+        self.restarts = 0
+
+    def _get_executor(self):
+        if self._executor is None:  # started on first use, after gunicorn / the dev server forked
+            self._executor = concurrent.futures.ProcessPoolExecutor(self._workers)
+        return self._executor
+
+    def _submit(self, func, args):
+        """submit to the pool, replacing it once if it broke (a pool process died), with self._lock held"""
+        try:
+            return self._get_executor().submit(func, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            print("job pool broken, starting a new one")
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            self.restarts += 1
+            return self._get_executor().submit(func, *args)
+
+    def submit(self, func, *args):
+        """queue func(*args) unless the same call is queued, running or done, returns the job key"""
+        key = job_key(func, args)
+        with self._lock:
+            finished = self._results.get(key)
+            if key in self._jobs or (finished is not None and finished[0] == 'done'):
+                self.merged += 1
+                return key
+            future = self._submit(func, args)
+            self._sequence += 1
+            self._jobs[key] = [future, time.monotonic(), self._sequence]
+            self.submitted += 1
+        future.add_done_callback(lambda f: self._finish(key, f))
+        return key
+
+    def _finish(self, key, future):
+        with self._lock:
+            job = self._jobs.pop(key, None)
+            if job is None:  # already finished by wait()
+                return
+            seconds = time.monotonic() - job[1]
+            error = future.exception()
+            self._results.put(key, ('failed', error, seconds) if error else ('done', future.result(), seconds))
+
+    def status(self, key):
+        """dict with state 'queued', 'running', 'done', 'failed' or 'unknown' (never submitted or expired),
+        elapsed seconds, jobs ahead in the queue while queued, result / error once finished"""
+        with self._lock:
+            job = self._jobs.get(key)
+        if job is not None and job[0].done():
+            self._finish(key, job[0])  # the done callback may not have run yet
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                future, submitted, sequence = job
+                if future.running():
+                    return {'state': 'running', 'elapsed': time.monotonic() - submitted}
+                ahead = sum(1 for f, _, s in self._jobs.values() if s < sequence and not f.running())
+                return {'state': 'queued', 'elapsed': time.monotonic() - submitted, 'ahead': ahead}
+            finished = self._results.get(key)
+        if finished is None:
+            return {'state': 'unknown'}
+        state, value, seconds = finished
+        return {'state': state, 'elapsed': seconds, 'result' if state == 'done' else 'error': value}
+
+    def wait(self, key, timeout=None):
+        """status() once the job finished or after timeout seconds, for long polling"""
+        with self._lock:
+            job = self._jobs.get(key)
+        if job is not None:
+            concurrent.futures.wait([job[0]], timeout)
+        return self.status(key)
+
+    def stats(self):
+        with self._lock:
+            return {'submitted': self.submitted, 'merged': self.merged, 'pending': len(self._jobs),
+                    'results': len(self._results), 'restarts': self.restarts}
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait)
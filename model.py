@@ -1,9 +1,11 @@
+import collections
 import math
 import pandas as pd
 import numpy as np
 import scipy.integrate
-from datetime import timedelta
+import cache
 import shared
+import supply
 # import world_data
 # import population
 
@@ -25,104 +27,386 @@ def model(Y, x, N, beta0, days0, beta1, gamma, sigma):
     return dS, dE, dI, dR
 
 
-def solve(model, population, E0, beta0, days0, beta1, gamma, sigma, days_total):
+def solve(model, population, E0, beta0, days0, beta1, gamma, sigma, days_total, method='odeint', steps_per_day=4):
+    # method='odeint' (default) integrates model with scipy's adaptive odeint.
+    # method='rk4-daily' runs a fixed step Runge-Kutta kernel with the SEIR equations of model() inlined
+    # (the model argument is not called), steps_per_day steps per day and output at whole days; the
+    # lockdown switch falls exactly on a step boundary. Max deviation from odeint relative to each
+    # compartment's peak, r0 1.5..5: 1.4e-3 with 1 step per day, 1e-4 with 2, 6e-6 with 4 (default),
+    # 6e-7 with 8. Per solve about 3 ms with 4 steps vs 4.5 - 7 ms for odeint, 1 ms with 1 step;
+    # python benchmark.py solve reports deviation and latency of both backends.
     X = np.arange(days_total)  # time steps list
     N0 = population - E0, E0, 0, 0  # S, E, I, R at initial step
 
-    y_data_var = scipy.integrate.odeint(model, N0, X, args=(population, beta0, days0, beta1, gamma, sigma))
+    if method == 'odeint':
+        y_data_var = scipy.integrate.odeint(model, N0, X, args=(population, beta0, days0, beta1, gamma, sigma))
+    elif method == 'rk4-daily':
+        y_data_var = _rk4_daily(N0, population, beta0, days0, beta1, gamma, sigma, days_total, steps_per_day)
+    else:
+        raise ValueError("solve: unknown method '%s'" % method)
 
     S, E, I, R = y_data_var.T  # transpose and unpack
     return X, S, E, I, R  # note these are all arrays
 
 
-def run_SEIR(population, date_of_first_infection, date_of_lockdown,
-             intensive_units, mean_days_icu,
-             vents_units_start, vents_units_sh1, vents_date_sh1,):
+def _rk4_daily(N0, N, beta0, days0, beta1, gamma, sigma, days_total, steps_per_day):
+    """_rk4_batch for a single scenario on plain floats: numpy's per call overhead dominates the
+    few flops per stage, so scalar arithmetic is several times faster than a 1 element batch."""
+    h = 1.0 / steps_per_day
+    h2, h6 = 0.5 * h, h / 6.0
+    S, E, I, R = (float(y) for y in N0)
+    N, beta0, days0, beta1, gamma, sigma = (float(a) for a in (N, beta0, days0, beta1, gamma, sigma))  # not numpy scalars
+    rows = [(S, E, I, R)]
+    for day in range(1, days_total):
+        for step in range(steps_per_day):
+            b = (beta0 if day - 1 + step * h < days0 else beta1) / N  # beta from the step start time
+            # stages: k = (dS, dE, dI), dR = gamma * I
+            i1 = b * S * I
+            kS1, kE1, kI1 = -i1, i1 - sigma * E, sigma * E - gamma * I
+            S2, E2, I2 = S + h2 * kS1, E + h2 * kE1, I + h2 * kI1
+            i2 = b * S2 * I2
+            kS2, kE2, kI2 = -i2, i2 - sigma * E2, sigma * E2 - gamma * I2
+            S3, E3, I3 = S + h2 * kS2, E + h2 * kE2, I + h2 * kI2
+            i3 = b * S3 * I3
+            kS3, kE3, kI3 = -i3, i3 - sigma * E3, sigma * E3 - gamma * I3
+            S4, E4, I4 = S + h * kS3, E + h * kE3, I + h * kI3
+            i4 = b * S4 * I4
+            kS4, kE4, kI4 = -i4, i4 - sigma * E4, sigma * E4 - gamma * I4
+            R += h6 * gamma * (I + 2 * I2 + 2 * I3 + I4)
+            S += h6 * (kS1 + 2 * kS2 + 2 * kS3 + kS4)
+            E += h6 * (kE1 + 2 * kE2 + 2 * kE3 + kE4)
+            I += h6 * (kI1 + 2 * kI2 + 2 * kI3 + kI4)
+        rows.append((S, E, I, R))
+    return np.array(rows)
+
+
+def model_batch(Y, x, N, beta0, days0, beta1, gamma, sigma):
+    # same as model() for n scenarios at once: Y is the stacked state S[0..n], E[0..n], I[0..n], R[0..n]
+    # and every parameter is an array of length n
+
+    S, E, I, R = Y.reshape(4, -1)
+
+    beta = np.where(x < days0, beta0, beta1)
+
+    infections = beta * S * I / N
+    dS = - infections
+    dE = infections - sigma * E
+    dI = sigma * E - gamma * I
+    dR = gamma * I
+    return np.concatenate((dS, dE, dI, dR))
+
+
+def _rk4_batch(N0, N, beta0, days0, beta1, gamma, sigma, days_total, steps_per_day):
+    """classic fixed step Runge-Kutta for the stacked state, output at whole days
+
+    beta is taken from the start of each step, so the lockdown switch happens exactly at a step
+    boundary as long as days0 is a multiple of the step length (whole days always are).
+    """
+    h = 1.0 / steps_per_day
+    Y = np.asarray(N0, dtype=float)
+    out = np.empty((days_total,) + Y.shape)
+    out[0] = Y
+    for day in range(1, days_total):
+        for step in range(steps_per_day):
+            t = day - 1 + step * h  # all four stages use the step start time to pick beta
+            args = (N, beta0, days0, beta1, gamma, sigma)
+            k1 = model_batch(Y, t, *args)
+            k2 = model_batch(Y + 0.5 * h * k1, t, *args)
+            k3 = model_batch(Y + 0.5 * h * k2, t, *args)
+            k4 = model_batch(Y + h * k3, t, *args)
+            Y = Y + h / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+        out[day] = Y
+    return out
+
+
+def solve_batch(population, E0, beta0, days0, beta1, gamma, sigma, days_total, method='rk4', steps_per_day=4):
+    """Integrate many SEIR scenarios in one call.
+
+    All parameters are scalars or arrays of the same length n (they are broadcast against each
+    other), days_total is shared. Returns an array of shape (n, 4, days_total) holding S, E, I, R
+    per scenario, i.e. result[i] is the transposed solve() output of scenario i.
+
+    method='rk4' (default) uses a fixed step Runge-Kutta integrator with steps_per_day steps per day
+    on the stacked state; cost grows linearly with steps_per_day. Measured max deviation from solve()
+    (odeint) relative to each compartment's peak, r0 1.5..5: 2e-3 with 1 step per day, 1e-4 with 2,
+    1e-5 with 4 (default), 1e-6 with 8. python benchmark.py solve_batch reports it.
+
+    method='odeint' hands the stacked right hand side to scipy's odeint. Results match solve() to
+    odeint's own tolerance, but the adaptive step is shared by all scenarios, so it only pays off
+    for up to a few hundred scenarios per call.
+    """
+    population, E0, beta0, days0, beta1, gamma, sigma = (
+        np.atleast_1d(a).astype(float)
+        for a in np.broadcast_arrays(population, E0, beta0, days0, beta1, gamma, sigma))
+    n = len(population)
+    N0 = np.concatenate((population - E0, E0, np.zeros(n), np.zeros(n)))  # S, E, I, R at initial step
+
+    if method == 'rk4':
+        y_data_var = _rk4_batch(N0, population, beta0, days0, beta1, gamma, sigma, days_total, steps_per_day)
+    elif method == 'odeint':
+        X = np.arange(days_total)
+        y_data_var = scipy.integrate.odeint(model_batch, N0, X, args=(population, beta0, days0, beta1, gamma, sigma))
+    else:
+        raise ValueError("solve_batch: unknown method '%s'" % method)
+
+    return y_data_var.reshape(days_total, 4, n).transpose(2, 1, 0)  # days, SEIR, scenario -> scenario, SEIR, days
+
+
+def _solve_segment(Y0, population, beta, gamma, sigma, days, method, steps_per_day):
+    """days x 4 states under a constant beta, row 0 is Y0"""
+    if method == 'odeint':
+        return scipy.integrate.odeint(model, Y0, np.arange(days), args=(population, beta, 0, beta, gamma, sigma))
+    if method == 'rk4-daily':
+        return _rk4_daily(Y0, population, beta, 0, beta, gamma, sigma, days, steps_per_day)
+    raise ValueError("solve_piecewise: unknown method '%s'" % method)
+
+
+def solve_piecewise(population, E0, schedule, gamma, sigma, days_total, method='odeint', steps_per_day=4):
+    """solve() with a piecewise constant beta(t): schedule is a sequence of (day, beta), days strictly
+    increasing and starting at 0, beta holds from its day until the next one.
+
+    Integrates segment by segment, each one starting from the state at its breakpoint. A segment is
+    integrated on to days_total and cached on the schedule up to and including its own breakpoint,
+    so changing a phase (its beta or its date) only re-integrates from that phase on: "what if we
+    reopen on day X" sweeps integrate just the tail after X. A cold solve of k phases costs up to
+    k single solves. Returns X, S, E, I, R like solve().
+    """
+    schedule = tuple((int(day), float(beta)) for day, beta in schedule)
+    days = [day for day, beta in schedule]
+    if not days or days[0] != 0 or any(b <= a for a, b in zip(days, days[1:])):
+        raise ValueError("solve_piecewise: schedule days must start at 0 and be strictly increasing, got %s" % days)
+
+    params = (population, E0, gamma, sigma, days_total, method, steps_per_day)
+    Y0 = (population - E0, E0, 0, 0)  # S, E, I, R at initial step
+    segments = []
+    for k, (start, beta) in enumerate(schedule):
+        if start >= days_total:
+            break
+        Y = segment_cache.get_or_compute(params + (schedule[:k + 1],), lambda: _readonly([
+            _solve_segment(Y0, population, beta, gamma, sigma, days_total - start, method, steps_per_day)]))[0]
+        end = days[k + 1] if k + 1 < len(days) else days_total
+        segments.append(Y[:end - start])
+        if end < days_total:
+            Y0 = Y[end - start]  # state at the next breakpoint
+
+    X = np.arange(days_total)
+    S, E, I, R = np.concatenate(segments).T
+    return X, S, E, I, R
+
+
+def _shift(values, days):
+    """shift to right along the last axis like pandas Series.shift, fill with NaN"""
+    shifted = np.full(values.shape, np.nan)
+    shifted[..., days:] = values[..., :values.shape[-1] - days]
+    return shifted
+
+
+def _gaussian_rolling_sum(values, window, std):
+    """Trailing gaussian-weighted window sum along the last axis, same as pandas
+    rolling(window, win_type='gaussian').sum(std=std).
+
+    The convolution accumulates one window tap at a time in the same order as pandas does, so results are
+    bit-identical. Windows touching a NaN (or the start of the series) are NaN.
+    """
+    taps = np.arange(0, window) - (window - 1.0) / 2.0
+    weights = np.exp(-taps ** 2 / (2 * std * std))  # scipy.signal.windows.gaussian, without importing scipy.signal
+    out = np.full(values.shape, np.nan)
+    if window > values.shape[-1]:
+        return out
+    n = values.shape[-1] - window + 1
+    total = np.zeros(values.shape[:-1] + (n,))
+    for k in range(window):
+        total += values[..., k:k + n] * weights[k]
+    out[..., window - 1:] = total
+    return out
+
+
+# --- external parameters ---
+days_total = 365  # total days to model
+# dataOffset = 'auto'  # position of real world data relative to model in whole days.
+# 'auto' will choose optimal offset based on matching of deaths curves
+
+E0 = 1  # number of exposed people at initial time step
+r0 = 3.0  # https://en.wikipedia.org/wiki/Basic_reproduction_number
+r1 = 1.1  # reproduction number after quarantine measures - https://papers.ssrn.com/sol3/papers.cfm?abstract_id=3539694
+
+# --- derived parameters ---
+# almost half infections take place before symptom onset (Drosten)
+# https://www.medrxiv.org/content/10.1101/2020.03.08.20032946v1.full.pdf
+days_presymptomatic = 2.5
+days_to_incubation = 5.2
+
+# sigma: The rate at which an exposed person becomes infective.  symptom onset - presympomatic
+sigma = 1.0 / (days_to_incubation - days_presymptomatic)
+
+# for SEIR: generation_time = 1/sigma + 0.5 * 1/gamma = timeFromInfectionToInfectiousness + timeInfectious  https://en.wikipedia.org/wiki/Serial_interval
+generation_time = 4.6  # https://www.medrxiv.org/content/10.1101/2020.03.05.20031815v1  http://www.cidrap.umn.edu/news-perspective/2020/03/short-time-between-serial-covid-19-cases-may-hinder-containment
+
+# gamma: The rate an infectious person recovers and moves into the resistant phase.
+# Note that for the model it only means he does not infect anybody any more.
+gamma = 1.0 / (2.0 * (generation_time - 1.0 / sigma))
+
+percent_asymptomatic = 0.35  # https://www.zmescience.com/medicine/iceland-testing-covid-19-0523/  but virus can already be found in throat 2.5 days before symptoms (Drosten)
+# wild guess! italy:16? germany:4 south korea: 4?  a lot of the mild cases will go undetected  assuming 100% correct tests
+percent_cases_detected = (1.0 - percent_asymptomatic) / 20.0
+
+days_in_hospital = 12
+days_infectious = 1.0 / gamma  # better days_infectious?
+
+# lag in whole days - need sources
+presymptomatic_lag = round(days_presymptomatic)
+communication_lag = 2
+test_lag = 3
+symptom_to_hospital_lag = 5
+hospital_to_icu_lag = 5
+
+infectionFatalityRateA = 0.01  # Diamond Princess, age corrected
+infectionFatalityRateB = infectionFatalityRateA * 3.0  # higher lethality without ICU - by how much?  even higher without oxygen and meds
+
+# icu_rate and vent_rate based on figures from Wuhan study https://www.thelancet.com/journals/lanres/article/PIIS2213-2600(20)30110-7/fulltext
+icu_rate = (52 / 710)
+vent_rate = (22 / 56)
+# icuRate = infectionFatalityRateA * 2  # Imperial College NPI study: hospitalized/ICU/fatal = 6/2/1
+
+s1 = 0.5 * (-(sigma + gamma) + math.sqrt((sigma + gamma) ** 2 + 4 * sigma * gamma * (
+            r0 - 1)))  # https://hal.archives-ouvertes.fr/hal-00657584/document page 13
+# doublingTime = (math.log(2.0, math.e) / s1)
+
+
+trajectory_cache = cache.LRUCache(shared.MODEL_CACHE_SIZE, shared.MODEL_CACHE_TTL)  # solve() results
+demand_cache = cache.LRUCache(shared.MODEL_CACHE_SIZE, shared.MODEL_CACHE_TTL)  # needs_icu, needs_ventilator
+segment_cache = cache.LRUCache(shared.MODEL_CACHE_SIZE, shared.MODEL_CACHE_TTL)  # solve_piecewise() segments
+
+Epidemic = collections.namedtuple('Epidemic', ['key', 'dates', 'S', 'E', 'I', 'R'])
+Demand = collections.namedtuple('Demand', ['needs_icu', 'needs_ventilator'])
+
+
+def _readonly(arrays):
+    """mark arrays read only before they go into a cache shared by all callers"""
+    for a in arrays:
+        a.flags.writeable = False
+    return arrays
+
 
-    # --- external parameters ---
-    days_total = 365  # total days to model
-    # dataOffset = 'auto'  # position of real world data relative to model in whole days.
-    # 'auto' will choose optimal offset based on matching of deaths curves
+def _beta_schedule(beta0, phases):
+    """solve_piecewise schedule from beta0 and (day, beta) phases: days before the first infection count
+    from day 0 like in solve(), of phases starting on the same day the later one (then the last given) wins"""
+    schedule = {0: beta0}
+    for day, beta in sorted(phases, key=lambda phase: (max(0, phase[0]), phase[0])):
+        schedule[max(0, day)] = beta
+    return sorted(schedule.items())
+
+
+def run_epidemic(population, date_of_first_infection, date_of_lockdown, r0=r0, r1=r1, method='odeint',
+                 interventions=None):
+    """Epidemic stage: susceptible, exposed, infectious and recovered per day.
+
+    The ODE solution is cached on its normalized parameters (key), so runs that share population
+    and days until lockdown only integrate once. method selects the solve() backend.
+    interventions: optional list of (date, r) phases after the lockdown (reopening, new restrictions),
+    solved with solve_piecewise so phases before a changed one are reused.
+    """
+    days_before_lockdown = (date_of_lockdown - date_of_first_infection).days
+    beta0 = r0 * gamma  # The parameter controlling how often a susceptible-infected contact results in a new infection.
+    beta1 = r1 * gamma  # beta0 is used during days0 phase, beta1 after days0
 
-    E0 = 1  # number of exposed people at initial time step
-    r0 = 3.0  # https://en.wikipedia.org/wiki/Basic_reproduction_number
-    r1 = 1.1  # reproduction number after quarantine measures - https://papers.ssrn.com/sol3/papers.cfm?abstract_id=3539694
+    if interventions:
+        schedule = _beta_schedule(beta0, [(days_before_lockdown, beta1)]
+                                  + [((date - date_of_first_infection).days, r * gamma) for date, r in interventions])
+        key = (population, E0, tuple(schedule), gamma, sigma, days_total, method)
+        X, S, E, I, R = trajectory_cache.get_or_compute(key, lambda: _readonly(
+            solve_piecewise(population, E0, schedule, gamma, sigma, days_total, method)))
+        dates = pd.Timestamp(date_of_first_infection) + pd.to_timedelta(X, unit='D')
+        return Epidemic(key, dates, S, E, I, R)
+
+    key = (population, E0, beta0, days_before_lockdown, beta1, gamma, sigma, days_total, method)
+    X, S, E, I, R = trajectory_cache.get_or_compute(key, lambda: _readonly(
+        solve(model, population, E0, beta0, days_before_lockdown, beta1, gamma, sigma, days_total, method)))
+    dates = pd.Timestamp(date_of_first_infection) + pd.to_timedelta(X, unit='D')
+    return Epidemic(key, dates, S, E, I, R)
+
+
+def demand(I, mean_days_icu, icu_rate=icu_rate, vent_rate=vent_rate):
+    """needs_icu and needs_ventilator per day for infectious I; works on (scenarios x days) arrays too,
+    with icu_rate / vent_rate per scenario shaped (scenarios, 1)"""
+    # Compute time series of patients who require intensive-care unit
+    needs_icu = np.rint(np.rint(I) * icu_rate)
+    # Number of patients who need an icu at any given time is a rolling function of those who needed it over the last x days
+    needs_icu = np.nan_to_num(_gaussian_rolling_sum(_shift(needs_icu, 10), mean_days_icu, std=3), nan=0.0)
 
-    # --- derived parameters ---
-    days_before_lockdown = (date_of_lockdown - date_of_first_infection).days
+    # Compute time series of patients who require mechanical ventilation
+    needs_ventilator = np.rint(needs_icu * vent_rate)
+    needs_ventilator = _gaussian_rolling_sum(_shift(needs_ventilator, 3), 3, std=3)
+    return Demand(needs_icu, needs_ventilator)
 
-    # almost half infections take place before symptom onset (Drosten)
-    # https://www.medrxiv.org/content/10.1101/2020.03.08.20032946v1.full.pdf
-    days_presymptomatic = 2.5
-    days_to_incubation = 5.2
 
-    # sigma: The rate at which an exposed person becomes infective.  symptom onset - presympomatic
-    sigma = 1.0 / (days_to_incubation - days_presymptomatic)
+def run_demand(epidemic, mean_days_icu, icu_rate=icu_rate, vent_rate=vent_rate):
+    """Demand stage: patients who need an ICU bed / a ventilator per day, cached per epidemic and ICU parameters."""
+    return demand_cache.get_or_compute(epidemic.key + (mean_days_icu, icu_rate, vent_rate),
+                                       lambda: _readonly(demand(epidemic.I, mean_days_icu, icu_rate, vent_rate)))
 
-    # for SEIR: generation_time = 1/sigma + 0.5 * 1/gamma = timeFromInfectionToInfectiousness + timeInfectious  https://en.wikipedia.org/wiki/Serial_interval
-    generation_time = 4.6  # https://www.medrxiv.org/content/10.1101/2020.03.05.20031815v1  http://www.cidrap.umn.edu/news-perspective/2020/03/short-time-between-serial-covid-19-cases-may-hinder-containment
 
-    # gamma: The rate an infectious person recovers and moves into the resistant phase.
-    # Note that for the model it only means he does not infect anybody any more.
-    gamma = 1.0 / (2.0 * (generation_time - 1.0 / sigma))
+def run_supply(dates, schedule):
+    """Supply stage: ventilators available per day from a supply.SupplySchedule. Cheap, never cached."""
+    return schedule.units(dates)
 
-    percent_asymptomatic = 0.35  # https://www.zmescience.com/medicine/iceland-testing-covid-19-0523/  but virus can already be found in throat 2.5 days before symptoms (Drosten)
-    # wild guess! italy:16? germany:4 south korea: 4?  a lot of the mild cases will go undetected  assuming 100% correct tests
-    percent_cases_detected = (1.0 - percent_asymptomatic) / 20.0
 
-    days_in_hospital = 12
-    days_infectious = 1.0 / gamma  # better days_infectious?
+class SEIRResult:
+    """Wide model output: a date index and one numpy array per series, all aligned on the dates."""
 
-    # lag in whole days - need sources
-    presymptomatic_lag = round(days_presymptomatic)
-    communication_lag = 2
-    test_lag = 3
-    symptom_to_hospital_lag = 5
-    hospital_to_icu_lag = 5
+    def __init__(self, dates, series):
+        self.dates = dates  # pandas DatetimeIndex
+        self.series = series  # name -> array, in plotting order
 
-    infectionFatalityRateA = 0.01  # Diamond Princess, age corrected
-    infectionFatalityRateB = infectionFatalityRateA * 3.0  # higher lethality without ICU - by how much?  even higher without oxygen and meds
+    def __getitem__(self, name):
+        return self.series[name]
 
-    # icu_rate and vent_rate based on figures from Wuhan study https://www.thelancet.com/journals/lanres/article/PIIS2213-2600(20)30110-7/fulltext
-    icu_rate = (52 / 710)
-    vent_rate = (22 / 56)
-    # icuRate = infectionFatalityRateA * 2  # Imperial College NPI study: hospitalized/ICU/fatal = 6/2/1
+    def __iter__(self):
+        return iter(self.series)
 
-    beta0 = r0 * gamma  # The parameter controlling how often a susceptible-infected contact results in a new infection.
-    beta1 = r1 * gamma  # beta0 is used during days0 phase, beta1 after days0
+    def __len__(self):
+        return len(self.dates)
 
-    s1 = 0.5 * (-(sigma + gamma) + math.sqrt((sigma + gamma) ** 2 + 4 * sigma * gamma * (
-                r0 - 1)))  # https://hal.archives-ouvertes.fr/hal-00657584/document page 13
-    # doublingTime = (math.log(2.0, math.e) / s1)
+    def to_frame(self):
+        """one column per series plus date, like the frame run_SEIR melts"""
+        return pd.DataFrame(dict({'date': self.dates}, **self.series))
 
-    X, S, E, I, R = solve(model, population, E0, beta0, days_before_lockdown, beta1, gamma, sigma, days_total)
+    def to_long(self):
+        """melted date / type / count frame as returned by run_SEIR"""
+        return self.to_frame().melt(id_vars=['date'], value_vars=list(self.series), value_name='count',
+                                    var_name='type')
 
-    demand_dict = {'days': X,
-                   'susceptible': S,
-                   'exposed': E,
-                   'infectious': I,
-                   'recovered': R,
-                   }
 
-    df = pd.DataFrame(demand_dict)
+def run_SEIR_wide(population, date_of_first_infection, date_of_lockdown,
+                  intensive_units, mean_days_icu,
+                  vents_units_start, vents_units_sh1, vents_date_sh1, vents_schedule=None, interventions=None):
+    """run_SEIR without the reshape: returns an SEIRResult with infectious, needs_icu, vents and needs_ventilator"""
+    if vents_schedule is None:
+        vents_schedule = supply.SupplySchedule([(vents_date_sh1, vents_units_sh1)], start=vents_units_start)
 
-    # Feature engineering
-    df['date'] = df['days'].apply(lambda x: date_of_first_infection + timedelta(days=x))
-    df['vents'] = df.apply(lambda x: vents_units_start if x['date'] < vents_date_sh1 else (vents_units_start + vents_units_sh1), axis=1)
-    df = df.applymap(lambda x: round(x) if isinstance(x, float) else x)
+    # the stages are cached independently, so runs that only differ in ICU units or ventilator supply
+    # reuse the trajectory and demand curves
+    epidemic = run_epidemic(population, date_of_first_infection, date_of_lockdown, interventions=interventions)
+    demand = run_demand(epidemic, mean_days_icu)
 
-    # Compute time series of patients who require intensive-care unit
-    df['needs_icu'] = df.apply(lambda x: round(x['infectious'] * icu_rate), axis=1)
-    # Number of patients who need an icu at any given time is a rolling function of those who needed it over the last x days
-    df['needs_icu'] = df['needs_icu'].shift(10).rolling(window=mean_days_icu, win_type='gaussian').sum(std=3)
-    df.fillna(0, inplace=True)
+    return SEIRResult(epidemic.dates, {
+        'infectious': np.rint(epidemic.I).astype(np.int64),  # same half-to-even rounding as builtin round()
+        'needs_icu': demand.needs_icu,
+        'vents': run_supply(epidemic.dates, vents_schedule),
+        'needs_ventilator': demand.needs_ventilator,
+    })
 
-    # Compute time series of patients who require mechanical ventilation
-    df['needs_ventilator'] = df.apply(lambda x: round(x['needs_icu'] * vent_rate), axis=1)
-    df['needs_ventilator'] = df['needs_ventilator'].shift(3).rolling(window=3, win_type='gaussian').sum(std=3)
-    df.drop(columns=['exposed'], inplace=True)
 
+def run_SEIR(population, date_of_first_infection, date_of_lockdown,
+             intensive_units, mean_days_icu,
+             vents_units_start, vents_units_sh1, vents_date_sh1, vents_schedule=None, interventions=None):
+    # vents_schedule: optional supply.SupplySchedule, replaces vents_units_start and the single shipment
+    # interventions: optional list of (date, r) phases after the lockdown, see run_epidemic
+    # long output (date, type, count); run_SEIR_wide returns the same data unreshaped
 
+    result = run_SEIR_wide(population, date_of_first_infection, date_of_lockdown,
+                           intensive_units, mean_days_icu,
+                           vents_units_start, vents_units_sh1, vents_date_sh1, vents_schedule, interventions)
 
     # # derived arrays
     # F = I * percent_cases_detected
@@ -154,13 +438,4 @@ def run_SEIR(population, date_of_first_infection, date_of_lockdown,
     #                  + symptom_to_hospital_lag + days_in_hospital
     #                  + communication_lag)  # deaths  from R
 
-
-
-
-
-    line_plot_data = df.melt(id_vars=['date'],
-                             value_vars=['infectious', 'needs_icu', 'vents', 'needs_ventilator'],
-                             value_name='count',
-                             var_name='type')
-
-    return line_plot_data
+    return result.to_long()
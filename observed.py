@@ -0,0 +1,101 @@
+"""Observed tracker data for the dashboard overlay.
+
+Region series come from one in-process cache that is emptied when world_data loads a new snapshot,
+so callbacks do not scan the location table again for a region they have seen. Long series are
+downsampled with largest triangle three buckets (LTTB) before they go to the browser.
+"""
+import contextlib
+import io
+import threading
+
+import numpy as np
+
+import cache
+import calibrate
+import model
+import shared
+import world_data
+
+_cache = cache.LRUCache(shared.OBSERVED_CACHE_SIZE)  # region options and series of the current snapshot
+_snapshot = None
+_lock = threading.Lock()
+
+
+def _current():
+    """the WorldData the cache holds series of, the cache is emptied when world_data loaded another one"""
+    global _snapshot
+    data = world_data.get_data()
+    with _lock:
+        if data is not _snapshot:
+            _cache.clear()
+            _snapshot = data
+    return data
+
+
+def region_options():
+    """dropdown options: every country, then the provinces as 'country / province' (value 'country|province')"""
+    data = _current()
+
+    def options():
+        countries, _ = data.countries_provinces()
+        provinces = sorted({(country, province) for country, province in zip(data.countries, data.provinces)
+                            if province})
+        return ([{'label': country, 'value': country} for country in countries]
+                + [{'label': '%s / %s' % pair, 'value': '%s|%s' % pair} for pair in provinces])
+    return _cache.get_or_compute((id(data), 'options'), options)
+
+
+def region_series(region):
+    """XCDR_data array (date, confirmed, deaths, recovered per day) of a region_options() value"""
+    data = _current()
+    country, _, province = region.partition('|')
+
+    def series():
+        with contextlib.redirect_stdout(io.StringIO()):  # get_country_xcdr is chatty
+            return fill_days(np.array(world_data.get_country_xcdr(country, province or 'all', returnDates=True)))
+    return _cache.get_or_compute((id(data), 'series', region), series)
+
+
+def fill_days(XCDR_data):
+    """XCDR_data on every day from its first to its last date, a day missing from the data (a reporting
+    gap) repeats the cumulative counts of the day before, as shared.get_offset_X expects continuous days"""
+    days = np.array(world_data.dates_to_days(XCDR_data[:, 0]))
+    if days[-1] - days[0] + 1 == len(days):
+        return XCDR_data
+    filled = XCDR_data[np.searchsorted(days, np.arange(days[0], days[-1] + 1), side='right') - 1]
+    filled[:, 0] = (np.datetime64(XCDR_data[0, 0], 'D') + np.arange(len(filled))).astype('M8[us]').tolist()
+    return filled
+
+
+def expected_deaths(R, ifr=model.infectionFatalityRateA):
+    """cumulative deaths of a model run, IFR * recovered delayed like calibrate.py, to align observed deaths with"""
+    deaths = np.zeros(len(R))
+    deaths[calibrate.death_lag:] = ifr * np.asarray(R)[:len(R) - calibrate.death_lag]
+    return deaths
+
+
+def lttb(x, y, threshold):
+    """Indices of the threshold points of (x, y) that largest triangle three buckets keeps.
+
+    First and last point are kept, the points in between are split into threshold - 2 buckets and
+    from each the one spanning the largest triangle with the point kept before and the mean of the
+    next bucket, so peaks and bends survive and straight stretches are thinned out.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    starts = np.arange(threshold - 1) * (n - 2) // (threshold - 2) + 1  # buckets, the last start is point n - 1
+    counts = np.diff(np.append(starts, n))
+    mean_x = np.add.reduceat(x, starts) / counts  # the last "bucket" is the last point
+    mean_y = np.add.reduceat(y, starts) / counts
+
+    keep = np.empty(threshold, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        bucket = slice(starts[i], starts[i + 1])
+        area = np.abs((x[a] - mean_x[i + 1]) * (y[bucket] - y[a]) - (x[a] - x[bucket]) * (mean_y[i + 1] - y[a]))
+        a = keep[i + 1] = starts[i] + np.argmax(area)
+    return keep
@@ -1,64 +1,166 @@
 import json
-import world_data
-
-with open('country-by-population.json') as f:
-    countryByPopulationJson = json.loads(f.read())
-
-countryPopulation = {}
-for item in countryByPopulationJson:
-    if not item['population']:
-        continue
-    countryPopulation[item['country']] = int(item['population'])
-
-cp2 = {}
+import os
+import re
+import threading
 
-# some fixes
-countryPopulation['US'] = countryPopulation['United States']
-countryPopulation['Czechia'] = countryPopulation["Czech Republic"]
-countryPopulation['Korea, South'] = countryPopulation['South Korea']
-countryPopulation['Korea, North'] = countryPopulation['North Korea']
-countryPopulation['Taiwan*'] = 23574274
-countryPopulation['Serbia'] = 7057666
+import numpy as np
 
-cp2['Hubei'] = 59E6
-# ...
-
-countries, provinces = world_data.get_countries_provinces()
+import shared
+import world_data
 
+# names used in the tracker data (and elsewhere) -> name in country-by-population.json
+ALIASES = {
+    'US': 'United States',
+    'Czechia': 'Czech Republic',
+    'Korea, South': 'South Korea',
+    'Korea, North': 'North Korea',
+    'Russia': 'Russian Federation',
+    'Burma': 'Myanmar',
+    'Cabo Verde': 'Cape Verde',
+    "Cote d'Ivoire": 'Ivory Coast',
+    'Congo (Brazzaville)': 'Congo',
+    'Eswatini': 'Swaziland',
+    'Fiji': 'Fiji Islands',
+    'Holy See': 'Holy See (Vatican City State)',
+    'Libya': 'Libyan Arab Jamahiriya',
+    'Timor-Leste': 'East Timor',
+    'West Bank and Gaza': 'Palestine',
+}
+# populations missing from (or outdated in) country-by-population.json
+POPULATIONS = {
+    'Taiwan*': 23574274,
+    'Serbia': 7057666,
+    'Hubei': 59E6,
+}
+
+_countryPopulation = None  # name in country-by-population.json -> population
+_index = None  # normalized name or alias -> population
+_resolved = {}  # names as queried -> population or None, skips normalize() on repeated lookups
+_cp2 = None  # name in the tracker data -> population
+_lock = threading.RLock()
+
+
+def normalize(name):
+    """case, punctuation and whitespace insensitive key: "Korea, South" -> 'korea south'"""
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', name.lower().replace('&', ' and ')).split())
+
+
+def _load_aliases(filename):
+    """optional json {alias: name in country-by-population.json or population}"""
+    if not filename or not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def load(alias_file=None):
+    """build the alias index from country-by-population.json, ALIASES, POPULATIONS and the alias file"""
+    global _countryPopulation, _index, _resolved, _cp2
+    with open('country-by-population.json') as f:
+        countryByPopulationJson = json.loads(f.read())
+
+    countryPopulation = {item['country']: int(item['population'])
+                         for item in countryByPopulationJson if item['population']}
+    index = {normalize(country): population for country, population in countryPopulation.items()}
+    aliases = dict(ALIASES, **_load_aliases(alias_file or shared.POPULATION_ALIAS_FILE))
+    for alias, target in aliases.items():
+        if isinstance(target, (int, float)):
+            index[normalize(alias)] = target
+        elif normalize(target) in index:
+            index[normalize(alias)] = index[normalize(target)]
+    for name, population in POPULATIONS.items():
+        index[normalize(name)] = population
+
+    with _lock:
+        _countryPopulation, _index, _resolved, _cp2 = countryPopulation, index, {}, None
+
+
+def _get_index():
+    if _index is None:
+        with _lock:
+            if _index is None:
+                load()
+    return _index
+
+
+def lookup(name, default=None):
+    """population of a country / region name or alias, default if unknown.
+
+    Names that are not in the index match a population name that contains all of their words, if
+    exactly one does - never a mere substring, so 'Niger' cannot pick up 'Nigeria'.
+    """
+    index = _get_index()
+    if name in _resolved:
+        population = _resolved[name]
+        return default if population is None else population
+    key = normalize(name)
+    if key not in index:
+        words = set(key.split()) - {'the'}
+        with _lock:  # other threads add names meanwhile
+            candidates = [k for k, population in index.items()
+                          if population is not None and words and words <= set(k.split())]
+            # remember misses too, the index only grows by queried names
+            index[key] = index[candidates[0]] if len(candidates) == 1 else None
+    population = _resolved[name] = index[key]
+    return default if population is None else population
+
+
+def get_populations(names):
+    """numpy array of the populations of names, NaN for unknown names"""
+    names = list(names)
+    for name in set(names).difference(_resolved):
+        lookup(name)
+    resolved = _resolved
+    return np.array([resolved[name] for name in names], dtype=float)
+
+
+def _get_cp2():
+    global _cp2
+    if _cp2 is None:
+        with _lock:
+            if _cp2 is None:
+                countries, provinces = world_data.get_countries_provinces()
+                cp2 = {'Hubei': lookup('Hubei')}
+                for country, population in zip(countries, get_populations(countries)):
+                    if not np.isnan(population):
+                        cp2[country] = population
+                _cp2 = cp2
+    return _cp2
 
-for country in countries:
-    if country in countryPopulation:
-        cp2[country] = countryPopulation[country]
-    else:
-        for country2 in countryPopulation:
-            if country in country2:
-                cp2[country] = countryPopulation[country2]
 
 def get_population(country, province='all', excludeCountries=[]):
     if province != 'all':
         country = province
     if country == 'all':
-        p = 7.8E9
-        for e in excludeCountries:
-            p -= get_population(e, 'all')
-        return p
-    if not country in cp2:
-        countries, provinces = world_data.get_countries_provinces()
-        print('\n', countries, '\n\n', provinces)
-        raise Exception('Country / province not found. See above.')
-    return cp2[country]
+        excluded = get_populations(excludeCountries)
+        unknown = [name for name, population in zip(excludeCountries, excluded) if np.isnan(population)]
+        if unknown:
+            _not_found(', '.join(unknown))
+        return 7.8E9 - excluded.sum()
+    population = lookup(country)
+    if population is None:
+        _not_found(country)
+    return population
+
+
+def _not_found(name):
+    countries, provinces = world_data.get_countries_provinces()
+    print('\n', countries, '\n\n', provinces)
+    raise Exception("Country / province not found: %s. See above." % name)
 
 def get_all_population_data():
-    return cp2
+    return _get_cp2()
 
 if __name__ == '__main__':
-    
+    cp2 = _get_cp2()
+    countries, provinces = world_data.get_countries_provinces()
+
     for country in countries:
         if not country in cp2:
             print(country)
     
     s = ''
-    for c in countryPopulation.keys():
+    for c in _countryPopulation.keys():
         if not c in countries:
             s += " %s " % c
     print(s)
@@ -0,0 +1,152 @@
+"""Many regions simulated together, and a shared ventilator stockpile allocated between them.
+
+All regions are one state array (S, E, I, R x regions) integrated with a fixed step Runge-Kutta
+scheme like model.solve_batch; an optional sparse mobility matrix couples the forces of infection.
+Ventilator demand per region comes from model.demand, then allocate() moves ventilators day by day:
+regions release what they do not need, the central pool ships to regions short of ventilators, in
+proportion to the shortfall, and shipments take transfer_days to arrive.
+"""
+import collections
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import model
+import population
+
+Allocation = collections.namedtuple('Allocation', ['dates', 'names', 'needs_ventilator', 'vents', 'unmet',
+                                                   'unmet_static'])
+
+
+def population_regions(names=None):
+    """names and populations from population.get_all_population_data(), all regions if names is None"""
+    data = population.get_all_population_data()
+    names = list(data) if names is None else list(names)
+    return names, np.array([data[name] for name in names], dtype=float)
+
+
+def mobility_matrix(flows, n):
+    """sparse n x n coupling matrix from (origin, destination, share) triples.
+
+    share: fraction of the origin's population mixing in the destination each day. Row r of the result
+    weights the infectious of every region in the force of infection of region r; the share that
+    travels is taken from the origin's own mixing.
+    """
+    flows = list(flows)
+    origin = np.array([f[0] for f in flows], dtype=int)
+    destination = np.array([f[1] for f in flows], dtype=int)
+    share = np.array([f[2] for f in flows], dtype=float)
+    stay = 1.0 - np.bincount(origin, weights=share, minlength=n)
+    rows = np.concatenate((np.arange(n), origin))
+    cols = np.concatenate((np.arange(n), destination))
+    return scipy.sparse.csr_matrix((np.concatenate((stay, share)), (rows, cols)), shape=(n, n))
+
+
+def _derivative(Y, N, beta, mobility):
+    S, E, I, R = Y
+    pressure = I / N if mobility is None else mobility @ (I / N)
+    infections = beta * S * pressure
+    return np.stack((-infections, infections - model.sigma * E, model.sigma * E - model.gamma * I, model.gamma * I))
+
+
+def simulate(populations, E0, beta0, days0, beta1, days_total, mobility=None, steps_per_day=4):
+    """(regions, 4, days) S, E, I, R like model.solve_batch; E0, beta0, days0, beta1 scalars or per region"""
+    N = np.asarray(populations, dtype=float)
+    E0, beta0, days0, beta1 = (np.broadcast_to(np.asarray(a, dtype=float), N.shape) for a in (E0, beta0, days0, beta1))
+    if mobility is None:
+        return model.solve_batch(N, E0, beta0, days0, beta1, model.gamma, model.sigma, days_total,
+                                 steps_per_day=steps_per_day)
+
+    h = 1.0 / steps_per_day
+    Y = np.stack((N - E0, E0, np.zeros_like(N), np.zeros_like(N)))
+    out = np.empty((days_total,) + Y.shape)
+    out[0] = Y
+    for day in range(1, days_total):
+        for step in range(steps_per_day):
+            beta = np.where(day - 1 + step * h < days0, beta0, beta1)  # from the step start, like model._rk4_batch
+            k1 = _derivative(Y, N, beta, mobility)
+            k2 = _derivative(Y + 0.5 * h * k1, N, beta, mobility)
+            k3 = _derivative(Y + 0.5 * h * k2, N, beta, mobility)
+            k4 = _derivative(Y + h * k3, N, beta, mobility)
+            Y = Y + h / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+        out[day] = Y
+    return out.transpose(2, 1, 0)
+
+
+def _share_out(deficits, available):
+    """whole ventilators for every deficit, proportional to it when available does not cover them all"""
+    deficits = np.ceil(deficits)
+    total = deficits.sum()
+    if total <= available:
+        return deficits
+    exact = deficits * (available / total)
+    shipped = np.floor(exact)
+    rest = int(available - shipped.sum())
+    if rest > 0:
+        shipped[np.argsort(shipped - exact)[:rest]] += 1  # largest remainders first
+    return shipped
+
+
+def _allocation_days(needs_ventilator, stockpile, holdings, transfer_days):
+    """allocate() day by day, yields (held, transit, pool) at the end of each day; the arrays are reused"""
+    regions, days = needs_ventilator.shape
+    held = np.zeros(regions) if holdings is None else np.asarray(holdings, dtype=float).copy()
+    transit = np.zeros((transfer_days + 1, regions))  # transit[k]: arriving in k days
+    pool = 0.0
+    for t in range(days):
+        held += transit[0]
+        transit = np.roll(transit, -1, axis=0)
+        transit[-1] = 0
+        pool += stockpile[t] - (stockpile[t - 1] if t else 0)
+
+        planned = needs_ventilator[:, min(t + transfer_days, days - 1)]
+        surplus = np.floor(np.maximum(0, held - np.maximum(needs_ventilator[:, t], planned)))
+        held -= surplus
+        pool += surplus.sum()
+
+        shipped = _share_out(np.maximum(0, planned - held - transit.sum(axis=0)), max(pool, 0.0))
+        pool -= shipped.sum()
+        if transfer_days:
+            transit[transfer_days - 1] += shipped
+        else:
+            held += shipped
+        yield held, transit, pool
+
+
+def allocate(needs_ventilator, stockpile, holdings=None, transfer_days=2):
+    """Daily ventilator allocation, returns (vents, unmet), both (regions, days).
+
+    needs_ventilator: (regions, days) demand
+    stockpile: central ventilators per day (cumulative, e.g. supply.SupplySchedule.units(dates))
+    holdings: ventilators each region starts with
+    transfer_days: days a shipment from the central pool takes, shipments are planned for the demand
+    on the day they arrive. Regions return every ventilator beyond their current and planned demand
+    to the pool the same day.
+    """
+    needs_ventilator = np.nan_to_num(needs_ventilator)
+    stockpile = np.broadcast_to(np.asarray(stockpile, dtype=float), (needs_ventilator.shape[1],))
+    vents = np.empty(needs_ventilator.shape)
+    for t, (held, _, _) in enumerate(_allocation_days(needs_ventilator, stockpile, holdings, transfer_days)):
+        vents[:, t] = held
+    return vents, np.maximum(0, needs_ventilator - vents)
+
+
+def run_regions(names, populations, date_of_first_infection, date_of_lockdown, mean_days_icu, stockpile_schedule,
+                holdings=None, mobility=None, E0=model.E0, r0=model.r0, r1=model.r1, transfer_days=2,
+                days_total=model.days_total):
+    """Simulate all regions together and allocate the stockpile, returns an Allocation.
+
+    date_of_lockdown: one date or one per region; E0: exposed at the start, scalar or per region
+    stockpile_schedule: supply.SupplySchedule of the central stockpile
+    unmet_static is the unmet demand if every region kept its holdings and the stockpile stayed put.
+    """
+    dates = pd.Timestamp(date_of_first_infection) + pd.to_timedelta(np.arange(days_total), unit='D')
+    lockdowns = np.atleast_1d(date_of_lockdown)
+    days0 = np.array([(d - date_of_first_infection).days for d in lockdowns], dtype=float)
+    SEIR = simulate(populations, E0, r0 * model.gamma, days0, r1 * model.gamma, days_total, mobility)
+    needs_ventilator = np.nan_to_num(model.demand(SEIR[:, 2], mean_days_icu).needs_ventilator)
+    vents, unmet = allocate(needs_ventilator, stockpile_schedule.units(dates), holdings, transfer_days)
+    static = np.zeros(len(names)) if holdings is None else np.asarray(holdings, dtype=float)
+    return Allocation(dates, list(names), needs_ventilator, vents, unmet,
+                      np.maximum(0, needs_ventilator - static[:, None]))
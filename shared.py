@@ -2,38 +2,91 @@
 CACHETIMESECONDS = 3600 * 3  # be nice to the API to not get banned
 
 APIURL = 'https://coronavirus-tracker-api.herokuapp.com/all'
+FETCH_TIMEOUT = 30  # seconds without an answer from APIURL before a refresh gives up
 FILENAME = 'covid-19_data.json'
 
+MODEL_CACHE_SIZE = 256  # number of SEIR trajectories / demand curves kept in memory per process
+MODEL_CACHE_TTL = None  # seconds, None: keep until evicted
+
+CALIBRATION_FILE = 'calibration.json'  # last fit per region, calibrate.py warm starts from it
+POPULATION_ALIAS_FILE = 'population-aliases.json'  # optional {alias: country name or population}, see population.py
+
+JOB_WORKERS = 2  # processes running model jobs for the Dash server (jobs.JobQueue)
+JOB_RESULT_TTL = 600  # seconds finished job results are kept for polling and repeated requests
+
+OBSERVED_CACHE_SIZE = 256  # observed region series kept by observed.py for the dashboard overlay
+OBSERVED_MAX_POINTS = 200  # longer observed series are downsampled (LTTB) to this many points per trace
+
 import datetime
 import numpy as np
-import scipy.ndimage.interpolation  # shift function
 
 import world_data
 
 def delay(npArray, days):
     """shift to right, fill with 0, values fall off!"""
-    return scipy.ndimage.interpolation.shift(npArray, days, cval=0)
+    import scipy.ndimage  # shift function, imported here to keep importing shared (and world_data) cheap
+    return scipy.ndimage.shift(npArray, days, cval=0)
+
+
+# per day loss of data d against model m, an offset is scored by sqrt(mean(loss)) over the compared days
+OFFSET_METRICS = {
+    'weighted_rms': lambda d, m: np.square(d - m) / (1 + m),  # hacky but seems to do the job
+    'rms': lambda d, m: np.square(d - m),
+    'log_rms': lambda d, m: np.square(np.log1p(d) - np.log1p(m)),
+}
+
 
+def offset_scores(D_data, D_models, offsets=range(0, 150), metric='weighted_rms'):
+    """Score every offset of the data relative to one or many model runs at once.
 
-def get_offset_X(XCDR_data, D_model, dataOffset='auto'):
+    For offset o the data is padded with o leading zeros and compared with the first len(D_data) + o
+    model days. D_models is one model run or an array of runs (n_runs, days); metric is a key of
+    OFFSET_METRICS or a vectorized function loss(d, m). Offsets that would run past the end of the
+    model are dropped. Returns (offsets, scores), scores shaped (n_offsets,) or (n_runs, n_offsets).
+    """
+    loss = OFFSET_METRICS.get(metric, metric)
+    D_data = np.asarray(D_data, dtype=float)
+    D_models = np.asarray(D_models, dtype=float)
+    offsets = np.asarray(offsets)
+    offsets = offsets[len(D_data) + offsets <= D_models.shape[-1]]
+    if len(offsets) == 0:
+        raise ValueError("offset_scores: model shorter than the data")
+    width = len(D_data) + offsets.max()
+
+    index = np.arange(width) - offsets[:, None]  # position in the data for every (offset, day), < 0 is padding
+    padded = np.where(index >= 0, D_data[np.clip(index, 0, len(D_data) - 1)], 0.0)  # like np.pad(D_data, (o, 0))
+    losses = loss(padded, D_models[..., np.newaxis, :width])
+    losses = np.where(index < len(D_data), losses, 0.0)  # days after data + offset are not compared
+    return offsets, np.sqrt(losses.sum(axis=-1) / (len(D_data) + offsets))
+
+
+def get_offset_X(XCDR_data, D_model, dataOffset='auto', offsets=range(0, 150), metric='weighted_rms'):
     X_days = world_data.dates_to_days(XCDR_data[:,0])
     X_days = np.array(X_days) - min(X_days)
     if dataOffset == 'auto':
         assert (max(X_days) - min(X_days) + 1) == len(X_days)  # continous data
         D_data = XCDR_data[:,2]
-        mini = 9e9
-        miniO = None
-        for o in range(0,150):  # todo: dat number...
-            oDd = np.pad(D_data, (o, 0))  # different than delay/shift, extends length
-            oDm = D_model[:len(D_data) + o]
-            rms = np.sqrt(np.mean(np.square((oDd - oDm))/(1 + oDm)))  # hacky but seems to do the job
-            if rms < mini:
-                mini = rms
-                miniO = o
-        print("date offset:", miniO)
-        dataOffset = miniO
+        offsets, scores = offset_scores(D_data, D_model, offsets, metric)
+        dataOffset = int(offsets[np.argmin(scores)])
+        print("date offset:", dataOffset)
     return dataOffset
 
+
+def get_offsets_batch(D_data_list, D_models, offsets=range(0, 150), metric='weighted_rms'):
+    """Best offset of each deaths series in D_data_list against each model run in D_models (n_runs, days).
+
+    Returns (offsets, scores), both shaped (len(D_data_list), n_runs). Every series is scored against
+    all runs and offsets in one vectorized step, e.g. to align all regions with a set of model runs.
+    """
+    D_models = np.atleast_2d(D_models)
+    best = np.zeros((len(D_data_list), len(D_models)), dtype=int)
+    best_scores = np.zeros(best.shape)
+    for i, D_data in enumerate(D_data_list):
+        candidates, scores = offset_scores(D_data, D_models, offsets, metric)
+        best[i] = candidates[np.argmin(scores, axis=1)]
+        best_scores[i] = scores.min(axis=1)
+    return best, best_scores
+
 def model_to_world_time(X, XCDR_data):
     X2 = np.array(X, dtype=np.dtype('M8[D]'))
     for i, x in enumerate(X):
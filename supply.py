@@ -0,0 +1,67 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+class SupplySchedule:
+    """Ventilator stock over time: a starting stock plus dated deliveries, losses and transfers.
+
+    Events are kept sorted by date together with the running total after each event, so the stock
+    at any date is one binary search (units_at) and a whole time axis is one vectorized
+    searchsorted (units). An event counts from its date on, same as the single shipment in run_SEIR.
+    """
+
+    def __init__(self, events=(), start=0):
+        """events: iterable of (date, delta), delta > 0 for deliveries, < 0 for losses / transfers out"""
+        events = list(events)
+        dates = pd.to_datetime([date for date, delta in events]).values.astype('M8[ns]')
+        deltas = np.array([delta for date, delta in events], dtype=np.int64)
+        order = np.argsort(dates, kind='stable')
+        self.start = int(start)
+        self.dates = dates[order]
+        self.deltas = deltas[order]
+        # stock before the first event, then after each event
+        self.cumulative = np.concatenate(([self.start], self.start + np.cumsum(self.deltas)))
+
+    @classmethod
+    def from_text(cls, text, start=0, date_format='%m-%d-%Y'):
+        """parse one 'date, delta' event per line, e.g. '03-20-2020, 200'
+
+        Blank lines, lines starting with # and a header line ('date, units', 'date,delta', ...: a first
+        line whose first field is not a date) are skipped.
+        """
+        events = []
+        first = True
+        for number, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            header, first = first, False
+            try:
+                date, delta = line.split(',')
+                date = datetime.strptime(date.strip(), date_format)
+            except ValueError:
+                if header and not line[:1].isdigit():
+                    continue
+                raise ValueError("supply schedule line %i: expected 'date, units', got '%s'" % (number, line))
+            try:
+                events.append((date, int(delta)))
+            except ValueError:
+                raise ValueError("supply schedule line %i: expected 'date, units', got '%s'" % (number, line))
+        return cls(events, start)
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def units_at(self, date):
+        """stock at a single date"""
+        return int(self.cumulative[np.searchsorted(self.dates, np.datetime64(pd.Timestamp(date)), side='right')])
+
+    def units(self, dates):
+        """stock for every date of an array / DatetimeIndex"""
+        dates = np.asarray(dates)
+        if dates.dtype.kind != 'M':
+            dates = np.asarray(pd.to_datetime(dates))
+        dates = dates.astype('M8[ns]', copy=False)
+        return self.cumulative[np.searchsorted(self.dates, dates, side='right')]
@@ -1,108 +1,441 @@
 import json
+import numpy as np
 import dateutil.parser
 import datetime
+import glob
+import os
 import os.path
-import time
+import re
+import threading
 
 import shared
 import fetch_data
 
-if (not os.path.exists(shared.FILENAME) or 
-    os.path.getmtime(shared.FILENAME) < time.time() - shared.CACHETIMESECONDS):
-        fetch_data.fetch()
-
 def dates_to_days(XDates):
+    first = min(XDates)
     XDays = []
     for date in XDates:
-        XDays.append((date - min(XDates)).days)
+        XDays.append((date - first).days)
     XDays.sort()
     return XDays
 
-with open(shared.FILENAME) as f:
-    s = f.read()
-    s = s.replace('Iran (Islamic Republic of)', 'Iran')  # obsolete?
-    s = s.replace('Mainland China', 'China')  # obsolete ?
-    s = s.replace('Korea, South', 'South Korea')
-    print("read data: %i bytes" % len(s))
-d = json.loads(s)
+RENAMES = [('Iran (Islamic Republic of)', 'Iran'),  # obsolete?
+           ('Mainland China', 'China'),  # obsolete ?
+           ('Korea, South', 'South Korea')]
+
+
+def _rename(name):
+    for old, new in RENAMES:
+        name = name.replace(old, new)
+    return name
+
+
+def _compact(location, parsed, sequences):
+    """(country, province, days, values) arrays of one location; parsed caches date string -> datetime64,
+    sequences the days array of every distinct list of date strings"""
+    history = location['history']
+    keys = tuple(history)
+    days = sequences.get(keys)
+    if days is None:  # locations share their dates, the days array is built once and shared too
+        days = sequences[keys] = np.empty(len(history), dtype='M8[D]')
+        for j, date in enumerate(history):
+            day = parsed.get(date)
+            if day is None:  # every date string is parsed once, not once per location
+                day = parsed[date] = np.datetime64(dateutil.parser.parse(date).date(), 'D')
+            days[j] = day
+    try:
+        values = np.fromiter(history.values(), dtype=np.int32, count=len(history))
+    except (TypeError, ValueError):  # numbers sent as strings
+        values = np.array([int(value) for value in history.values()], dtype=np.int32)
+    return _rename(str(location['country'])), _rename(str(location['province'])), days, values
+
+
+class _JSONStream:
+    """Minimal pull parser for a json text file.
+
+    Walks objects and arrays one key / element at a time and decodes single values with the json
+    module's C decoder, so only the current value (e.g. one location) is ever materialized.
+    """
+
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.size = 0
+        self.decoder = json.JSONDecoder()
+
+    def _read(self):
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.size += len(chunk)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """next non whitespace character, '' at the end of the file"""
+        while True:
+            self.pos = self._whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._read()
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("json stream: expected one of '%s' at character %i, got '%s'"
+                             % (chars, self.size - len(self.buf) + self.pos, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """decode the next value, reading more of the file until it is complete"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:  # a number at the end of the buffer may continue
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+    def items(self):
+        """yield the keys of an object, the caller consumes each value before asking for the next key"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """yield once per array element, the caller consumes each element"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(',]') == ']':
+                return
+
+
+class WorldData:
+    """Tracker data parsed once into columns.
+
+    dates: day axis (datetime64[D]) shared by all locations
+    countries, provinces: one entry per location (row)
+    confirmed, deaths, recovered: (location x day) int32 matrices, 0 where a location has no data
+    first_day: index of the first date a location reports, for the day numbering of get_country_xcdr
+    country_index, province_index: name -> array of rows
+    keys: the tracker's date strings of dates when all locations report the same dates, else None;
+    they let the next download parse only its new dates and extend() this data
+    """
+
+    def __init__(self, dates, countries, provinces, confirmed, deaths, recovered, first_day, keys=None):
+        self.dates = dates
+        self.countries = countries
+        self.provinces = provinces
+        self.confirmed = confirmed
+        self.deaths = deaths
+        self.recovered = recovered
+        self.first_day = first_day
+        self.keys = keys
+        self.country_index = self._index(countries)
+        self.province_index = self._index(provinces)
+        self._country_totals = None
+
+    @staticmethod
+    def _index(names):
+        index = {}
+        for row, name in enumerate(names):
+            index.setdefault(name, []).append(row)
+        return {name: np.array(rows) for name, rows in index.items()}
+
+    @classmethod
+    def from_json(cls, d):
+        """from the fully parsed json dict"""
+        parsed, sequences = {}, {}
+        return cls._from_compact(*([_compact(location, parsed, sequences) for location in d[category]['locations']]
+                                   for category in ('confirmed', 'deaths', 'recovered')), sequences=sequences)
+
+    @classmethod
+    def from_stream(cls, f, previous=None):
+        """from a json text file object, without building the python object tree of the whole file.
+
+        previous: WorldData of an earlier download. Its dates are not parsed again and, when the file
+        only adds days to it, the new days are appended to it instead of rebuilding all matrices.
+        """
+        stream = _JSONStream(f)
+        parsed, sequences = {}, {}
+        if previous is not None and previous.keys is not None:
+            parsed.update(zip(previous.keys, previous.dates))
+        categories = {'confirmed': [], 'deaths': [], 'recovered': []}
+        for category in stream.items():
+            if category not in categories:
+                stream.value()  # 'latest' totals etc.
+                continue
+            for key in stream.items():
+                if key != 'locations':
+                    stream.value()
+                    continue
+                for _ in stream.elements():
+                    categories[category].append(_compact(stream.value(), parsed, sequences))
+        print("read data: %i bytes" % stream.size)
+        if previous is not None:
+            data = previous.extend(categories['confirmed'], categories['deaths'], categories['recovered'], sequences)
+            if data is not None:
+                print("appended %i days" % (len(data.dates) - len(previous.dates)))
+                return data
+            print("history changed, rebuilding all days")
+        return cls._from_compact(categories['confirmed'], categories['deaths'], categories['recovered'],
+                                 sequences=sequences)
+
+    @staticmethod
+    def _shared_keys(sequences, dates):
+        """the date strings if every location had the same ones (one entry in sequences) covering dates"""
+        if len(sequences) == 1:
+            keys, days = next(iter(sequences.items()))
+            if np.array_equal(days, dates):
+                return list(keys)
+        return None
+
+    @classmethod
+    def _from_compact(cls, confirmed, deaths, recovered, sequences=None):
+        """Lists of _compact() locations per category, matched by position like the tracker api does.
+        Dates and locations come from confirmed; deaths / recovered count on the dates of their
+        confirmed location, missing values are 0."""
+        dates = np.unique(np.concatenate([days for country, province, days, values in confirmed]
+                                         + [np.empty(0, dtype='M8[D]')]))
+        shape = (len(confirmed), len(dates))
+        matrices = np.zeros((3,) + shape, dtype=np.int32)
+        first_day = np.full(len(confirmed), len(dates))
+        for i, (country, province, days, values) in enumerate(confirmed):
+            if len(days) == 0:
+                continue
+            columns = np.searchsorted(dates, days)
+            matrices[0, i, columns] = values
+            first_day[i] = columns.min()
+            for matrix, locations in zip(matrices[1:], (deaths, recovered)):
+                if i < len(locations):
+                    other_days, other_values = locations[i][2:]
+                    valid = np.isin(other_days, days)
+                    matrix[i, np.searchsorted(dates, other_days[valid])] = other_values[valid]
+
+        countries = np.array([location[0] for location in confirmed], dtype=object)
+        provinces = np.array([location[1] for location in confirmed], dtype=object)
+        keys = cls._shared_keys(sequences, dates) if sequences else None
+        return cls(dates, countries, provinces, matrices[0], matrices[1], matrices[2], first_day, keys)
+
+    def extend(self, confirmed, deaths, recovered, sequences):
+        """This data with the days after dates[-1] of the _compact() locations appended, or None.
+
+        None unless every location of every category reports exactly the dates of this data plus the
+        new ones and all values up to dates[-1] are unchanged: locations added or moved, a revised,
+        added or dropped past day all need the full _from_compact(). deaths / recovered rows are matched
+        by position like there, the tracker's recovered list is shorter and missing rows are 0. Only the
+        new days are copied into the matrices and added to the country_totals() if those were computed.
+        """
+        if (self.keys is None or len(sequences) != 1 or len(confirmed) != len(self.countries)
+                or len(deaths) > len(confirmed) or len(recovered) > len(confirmed)):
+            return None
+        keys, days = next(iter(sequences.items()))
+        keys = list(keys)
+        old = len(self.dates)
+        if keys[:old] != self.keys or np.any(np.diff(days[old - 1:]) <= np.timedelta64(0, 'D')):
+            return None
+        if any(location[0] != country or location[1] != province
+               for location, country, province in zip(confirmed, self.countries, self.provinces)):
+            return None
+
+        matrices = np.zeros((3, len(self.countries), len(days)), dtype=np.int32)
+        for matrix, locations in zip(matrices, (confirmed, deaths, recovered)):
+            for i, location in enumerate(locations):
+                matrix[i] = location[3]
+        if not all(np.array_equal(matrix[:, :old], past)
+                   for matrix, past in zip(matrices, (self.confirmed, self.deaths, self.recovered))):
+            return None
+
+        data = WorldData(days, self.countries, self.provinces, matrices[0], matrices[1], matrices[2],
+                         np.zeros_like(self.first_day), keys)  # with shared dates all start on day 0
+        if self._country_totals is not None:
+            names, totals = self._country_totals
+            data._country_totals = names, np.concatenate((totals, data._country_sums(matrices[:, :, old:])), axis=2)
+        return data
+
+    def save(self, npy_path, meta_path):
+        """write the matrices as one .npy (memory mappable) and the rest as json, each via an atomic rename.
+        The meta file is written last, so its presence means the cache is complete."""
+        tmp = '.tmp%i' % os.getpid()
+        with open(npy_path + tmp, 'wb') as f:
+            np.save(f, np.stack((self.confirmed, self.deaths, self.recovered)))
+        os.replace(npy_path + tmp, npy_path)
+        meta = {'version': CACHE_VERSION,
+                'dates': [str(date) for date in self.dates],
+                'countries': list(self.countries),
+                'provinces': list(self.provinces),
+                'first_day': self.first_day.tolist(),
+                'keys': self.keys}
+        with open(meta_path + tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + tmp, meta_path)
+
+    @classmethod
+    def load(cls, npy_path, meta_path):
+        """counterpart of save(), the matrices are memory mapped read only so processes share the pages"""
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION:
+            return None
+        confirmed, deaths, recovered = np.load(npy_path, mmap_mode='r')
+        return cls(np.array(meta['dates'], dtype='M8[D]'),
+                   np.array(meta['countries'], dtype=object), np.array(meta['provinces'], dtype=object),
+                   confirmed, deaths, recovered, np.array(meta['first_day']), meta['keys'])
+
+    def rows(self, country='', province='', excludeCountries=(), excludeProvinces=()):
+        """row numbers of the locations matching country / province ('' for all) minus the excluded ones"""
+        rows = np.arange(len(self.countries))
+        if country != '':
+            rows = self.country_index.get(country, rows[:0])
+        if province != '':
+            rows = np.intersect1d(rows, self.province_index.get(province, rows[:0]))
+        excluded = self.countries[rows]
+        keep = ~np.isin(excluded, list(excludeCountries)) & ~np.isin(self.provinces[rows], list(excludeProvinces))
+        for row in rows[~keep]:
+            print("Excluded country/province:", self.countries[row], self.provinces[row])
+        return rows[keep]
+
+    def aggregate(self, rows):
+        """confirmed, deaths, recovered per day summed over rows"""
+        return (self.confirmed[rows].sum(axis=0, dtype=np.int64),
+                self.deaths[rows].sum(axis=0, dtype=np.int64),
+                self.recovered[rows].sum(axis=0, dtype=np.int64))
+
+    def _country_sums(self, matrices):
+        """(3, location x day) matrices summed per country, in the order of np.unique(countries)"""
+        order = np.argsort(self.countries, kind='stable')
+        starts = np.flatnonzero(np.r_[True, self.countries[order][1:] != self.countries[order][:-1]])
+        return np.add.reduceat(matrices[:, order].astype(np.int64), starts, axis=1)
+
+    def country_totals(self):
+        """(countries, totals): sorted country names and their (3, country x day) int64 confirmed, deaths and
+        recovered, computed once per WorldData; extend() appends the new days to it"""
+        if self._country_totals is None:
+            self._country_totals = (np.unique(self.countries),
+                                    self._country_sums(np.stack((self.confirmed, self.deaths, self.recovered))))
+        return self._country_totals
+
+    def countries_provinces(self):
+        return sorted(set(self.countries)), sorted(set(self.provinces))
+
+
+CACHE_VERSION = 2
+
+
+def _cache_paths(filename):
+    """binary cache files next to the json, keyed on its modification time and size"""
+    stat = os.stat(filename)
+    stem = '%s.%i-%i' % (filename, stat.st_mtime_ns, stat.st_size)
+    return stem + '.npy', stem + '.meta.json'
+
+
+def _previous_cache(filename, meta_path):
+    """WorldData from the newest cache of an older download of filename, None if there is none"""
+    paths = [path for path in glob.glob(glob.escape(filename) + '.*-*.meta.json') if path != meta_path]
+    for path in sorted(paths, key=os.path.getmtime, reverse=True)[:1]:
+        try:
+            return WorldData.load(path[:-len('.meta.json')] + '.npy', path)
+        except (OSError, ValueError, KeyError) as e:
+            print("could not read old data cache:", e)
+    return None
+
+
+def load_data(filename=shared.FILENAME, previous=None):
+    """WorldData for the json file, memory mapped from the binary cache when that is up to date.
+
+    Otherwise the file is parsed; when it only adds days to previous (default: the cache of the last
+    download) those days are appended to it, else all of it is rebuilt.
+    """
+    npy_path, meta_path = _cache_paths(filename)
+    if os.path.exists(meta_path):
+        data = WorldData.load(npy_path, meta_path)
+        if data is not None:
+            return data
+
+    if previous is None:
+        previous = _previous_cache(filename, meta_path)
+    with open(filename) as f:
+        data = WorldData.from_stream(f, previous)
+    try:
+        data.save(npy_path, meta_path)
+    except OSError as e:
+        print("could not write data cache:", e)
+        return data
+
+    for path in glob.glob(glob.escape(filename) + '.*-*.npy') + glob.glob(glob.escape(filename) + '.*-*.meta.json'):
+        if path not in (npy_path, meta_path):  # caches of older downloads
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return data
+
+
+_data = None
+_lock = threading.RLock()
+
+
+def load():
+    """(re)load the data: fetch it if the local file is missing or stale, then parse / memory map it"""
+    global _data
+    with _lock:
+        if fetch_data.is_stale(shared.FILENAME, shared.CACHETIMESECONDS):
+            try:
+                fetch_data.fetch(shared.APIURL, shared.FILENAME, max_age=shared.CACHETIMESECONDS)
+            except OSError as e:  # includes timeouts and FetchError, serve the last download if there is one
+                if not os.path.exists(shared.FILENAME):
+                    raise
+                print("could not refresh data, using the last download:", e)
+        _data = load_data(shared.FILENAME, previous=_data)
+    return _data
+
+
+def get_data():
+    """the process wide WorldData, loaded on first use; importing this module does no I/O"""
+    if _data is None:
+        with _lock:
+            if _data is None:
+                load()
+    return _data
+
 
 # todo check for unknown excluded countries
 def get_country_xcdr(country='all', province='all', excludeCountries=[], excludeProvinces=[],
                      dateOffset=0, returnLists=False, returnDates=False):
     country = '' if country == 'all' else country  # empty string is same as all
     province = '' if province == 'all' else province
-    countries = {}
-    provinces = {}
-
-    dictXYYY = {}
-    XDatesAll = []
-    
-    for i, location in enumerate(d['confirmed']['locations']):
-        XDates = []
-        YConfirmed = []
-        YDeaths = []
-        YRecovered = []
-        listXYYY = []
-
-        countries[str(location['country'])] = 1
-        provinces[str(location['province'])] = 1
-
-        if country != '' and location['country'] != country:
-            continue
-        if location['country'] in excludeCountries:
-            print("Excluded country/province:", location['country'], location['province'])
-            continue
-
-        if province != '' and location['province'] != province:
-            continue
-        if location['province'] in excludeProvinces:  # global provinces can't have the same name
-            print("Excluded country/province:", location['country'], location['province'])
-            continue
-    
-        for date in location['history']:
-            confirmed = int(location['history'][date])
-            deaths = int(d['deaths']['locations'][i]['history'][date])
-            try:
-                recovered = int(d['recovered']['locations'][i]['history'][date])
-            except (KeyError, IndexError):
-                recovered = 0
-            XDates.append(dateutil.parser.parse(date))
-            YConfirmed.append(confirmed)
-            YDeaths.append(deaths)
-            YRecovered.append(recovered)
-
-        for i, date in enumerate(XDates):
-            if date in dictXYYY:
-                dictXYYY[date][0] += YConfirmed[i]
-                dictXYYY[date][1] += YDeaths[i]
-                dictXYYY[date][2] += YRecovered[i]
-            else:    
-                dictXYYY[date] = [YConfirmed[i], YDeaths[i], YRecovered[i]]
-        XDatesAll.extend(XDates)
-    
-    listXYYY = []
-    XDatesAllNonEmpty = []
-    for date in dictXYYY:
-        day = (date - min(XDatesAll)).days + dateOffset
-        C, D, R = dictXYYY[date][0], dictXYYY[date][1], dictXYYY[date][2]
-        if (C + D + R) > 0:
-            if returnDates:
-                x = date
-            else:
-                x = day
-            listXYYY.append((x, C, D, R))
-            XDatesAllNonEmpty.append(date)
-    listXYYY.sort()  # in place by first item
-    
+
+    data = get_data()
+
     # parse countries just to display available ones in case of error
     if returnLists:
-        countries = list(countries.keys())
-        countries.sort()
-        provinces = list(provinces.keys())
-        provinces.sort()
-        return countries, provinces
+        return data.countries_provinces()
 
-    if len(listXYYY) == 0:
+    rows = data.rows(country, province, excludeCountries, excludeProvinces)
+    C, D, R = data.aggregate(rows)
+    nonEmpty = np.flatnonzero((C + D + R) > 0)
+
+    if len(nonEmpty) == 0:
         countries, provinces = get_countries_provinces()
         if not country in countries:
             print(countries)
@@ -111,10 +444,16 @@ def get_country_xcdr(country='all', province='all', excludeCountries=[], exclude
             print(provinces)
         raise Exception("get_country_xcdr empty - country '%s' or province '%s' not found?" % (country, province))
 
+    if returnDates:
+        X = data.dates[nonEmpty].astype('M8[us]').tolist()  # datetime.datetime
+    else:
+        X = (nonEmpty - data.first_day[rows].min() + dateOffset).tolist()
+    listXYYY = list(zip(X, C[nonEmpty].tolist(), D[nonEmpty].tolist(), R[nonEmpty].tolist()))
+
     print("todays date: %s" % datetime.date.today())
     print("data points for %s: %s" % (country, len(listXYYY)))
-    print("first data: %s" % min(XDatesAllNonEmpty).date())
-    print("latest data: %s (you can update the data manually by running fetch_data.py)" % max(XDatesAll).date())
+    print("first data: %s" % data.dates[nonEmpty[0]])
+    print("latest data: %s (you can update the data manually by running fetch_data.py)" % data.dates[-1])
 
     return listXYYY
 
@@ -123,7 +462,6 @@ def get_countries_provinces():  # todo: make this a separate function for easier
     return countries, provinces
 
 if __name__ == '__main__':
-    import numpy as np
     import matplotlib.pyplot as plt
 
     fig = plt.figure(figsize=(10,10), dpi=200)